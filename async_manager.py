@@ -1,95 +1,400 @@
 
-import asyncio, aiohttp, logging
+import asyncio, logging, threading, time
+from concurrent.futures import ThreadPoolExecutor
 from data_clients import Integrator
+from transform import ResponseTransformer, pa
+from metrics import metrics
 
 class AsyncManager():
-    def __init__(self, orbit):
+    #tables the enriched users are written to, the keys are only used by upserts
+    JOBS = [
+        {'name': 'User Injection', 'table': 'gitpod-growth.orbit.users', 'keys': ['github']},
+        {'name': 'Languages Injection', 'table': 'gitpod-growth.orbit.languages', 'keys': ['github', 'language']}
+    ]
+
+    def __init__(self, orbit, **kwargs):
         self.orbit = orbit
+        #if a journal is attached, finished users are skipped and journaled responses are not posted again
+        self.journal = kwargs.get('journal', None)
+        #if a cache is attached, cached Orbit responses are used instead of posting the users again
+        self.cache = kwargs.get('cache', None)
+        #if a change index is attached, users that have not changed since their last enrichment are taken from the cache
+        self.changes = kwargs.get('changes', None)
+        #unchanged users are posted again once their cached response is older than refresh_age seconds (None never does)
+        self.refresh_age = kwargs.get('refresh_age', 30 * 24 * 60 * 60)
+        #executor running the BigQuery inserts, a pool of four threads is created per run if None
+        self.executor = kwargs.get('executor', None)
+        #keywords passed to each Integrator, e.g. {'mode': 'load'} for bulk runs with large batches
+        self.write_options = kwargs.get('write_options', {})
+        self.transformer = kwargs.get('transformer', ResponseTransformer())
+        #number of rows of the last run that could not be written to BigQuery
+        self.errors = 0
 
-    async def process_batch(self,batch,rate_limit,timeout):
+    async def process_batch(self,batch,batch_size,queue_size,max_ingestions,max_windows=4):
         """
         makes call to Orbit API to add users asynchronously and then streams the
-        results into BigQuery.
+        results into BigQuery in sub batches of batch_size users. batch can be any
+        iterable of users (e.g. the generator returned by Accessor.stream). It is
+        consumed through a queue holding at most queue_size users, so that memory
+        stays constant regardless of the size of the source. Up to max_windows sub
+        batches are in progress at once, so that the requests of the next sub batches
+        are scheduled while the slowest requests of a sub batch are still pending. The
+        number of in-flight requests is limited by the concurrency controller of the
+        orbit instance. The BigQuery inserts of up to max_ingestions sub batches run
+        at the same time. In 'load' and 'upsert' mode, the sub batches are appended to
+        one staging table per table, which is written into the table once the run has
+        completed. Returns the number of processed users, while the number of rows that
+        could not be written to BigQuery is kept in errors.
         """
 
-        async def stream_batch(batch):
+        async def add_members(session, sub_batch):
             """
-            parses user responses and streams them into BigQuery. As this is processed
-            during a timeout in under to stay under the Orbit rate limit, sequential
-            execution of the steps in this method do not cause a performance penality.
+            posts the users of the sub batch to Orbit and returns the responses as well as the ids of the users that
+            were enriched successfully. Users occurring several times in the sub batch are only posted once. If a journal
+            is attached, finished users are skipped and the journaled responses of users that have been posted but not
+            ingested are reused. If a cache is attached, cached responses are used instead of posting the users. If a
+            change index is attached as well, only the responses of unchanged users are taken from the cache (up to an age
+            of refresh_age instead of the ttl of the cache), while new and changed users are always posted.
             """
-            users, langs = [], []
-            for row in batch:
-                #skip rows where erroneous requests were made
-                if row is None:
-                    continue
-                user_response, lang_response = self.orbit.parse_user_response(row)
-                if user_response != None:
-                    users.append(user_response)
-                if lang_response != None:
-                    for lang in lang_response:
-                        langs.append(lang)
-
-            #declaring jobs for the data injection
-            jobs = [
-                {
-                    'name': 'User Injection',
-                    'table': 'gitpod-growth.orbit.users',
-                    'payload': users
-                },
-                {
-                    'name': 'Languages Injection',
-                    'table': 'gitpod-growth.orbit.languages',
-                    'payload': langs
-                }
-            ]
-
-            #executing the injection
-            for job in jobs:
-                if len(job['payload'] == 0):
-                    logging.info(f"Job '{job['name']} has empty payload. No call to BigQuery is made.")
-                    continue
-                logging.info(f"Executing Job '{job['name']}'...")
-                integrator = Integrator(job['table'], job['payload'])
-                integrator.execute()
-                logging.info(f"Execution of Job '{job['name']}' has completed. {len(integrator.errors)} errors occurred.")
-                for error in integrator.errors:
-                    logging.error(error)
-
-        async def set_timeout(mins):
-            logging.info(f"Timing out for {mins} minute(s) in order to stay under the Orbit rate limit...")
-            await asyncio.sleep(mins*60)
-            logging.info(f"Timeout of {mins} minute(s) has completed. Resuming batch job...")        
-        
-        async with aiohttp.ClientSession() as session:
-            lower = 0
-            while lower < len(batch):
-                sub_batch = batch[lower:(lower+rate_limit)]
-                logging.info(f'Now starting to insert users from batch {lower+1}-{lower+len(sub_batch)} into Orbit...')
-                tasks = [asyncio.ensure_future(self.orbit.async_add_member(session,user)) for user in sub_batch]
+            #collapse users that occur several times in the sub batch
+            unique = {}
+            for user in sub_batch:
+                unique.setdefault(user.get_id() or id(user), user)
+            if len(unique) < len(sub_batch):
+                logging.info(f'{len(sub_batch) - len(unique)} duplicate users of the batch were collapsed.')
+                metrics.inc('users_skipped_total', len(sub_batch) - len(unique), reason = 'duplicate')
+            pending, posted, cached = list(unique.values()), {}, {}
+
+            if self.journal != None:
+                ids = [user.get_id() for user in pending]
+                finished, posted = self.journal.finished(ids), self.journal.posted(ids)
+                pending = [user for user in pending if user.get_id() not in finished and user.get_id() not in posted]
+                if len(pending) < len(unique):
+                    logging.info(f'{len(unique) - len(pending)} users of the batch were found in the journal and are not posted again.')
+                    metrics.inc('users_skipped_total', len(unique) - len(pending), reason = 'journal')
+
+            if self.cache != None and self.changes != None:
+                unchanged = self.changes.unchanged(pending)
+                cached = self.cache.get([user.get_id() for user in pending if user.get_id() in unchanged], max_age = self.refresh_age)
+                pending = [user for user in pending if user.get_id() not in cached]
+                if len(cached) > 0:
+                    logging.info(f'{len(cached)} users of the batch have not changed and are refreshed from the cache.')
+                    metrics.inc('users_skipped_total', len(cached), reason = 'unchanged')
+            elif self.cache != None:
+                cached = self.cache.get([user.get_id() for user in pending])
+                pending = [user for user in pending if user.get_id() not in cached]
+                if len(cached) > 0:
+                    logging.info(f'{len(cached)} users of the batch were found in the cache and are not posted again.')
+                    metrics.inc('users_skipped_total', len(cached), reason = 'cache')
 
+            #users that are still being posted by an earlier window are ingested by that window
+            if any(user.get_id() in posting for user in pending):
+                skipped = len(pending)
+                pending = [user for user in pending if user.get_id() not in posting]
+                logging.info(f'{skipped - len(pending)} users of the batch are being posted by an earlier batch and are skipped.')
+                metrics.inc('users_skipped_total', skipped - len(pending), reason = 'in_flight')
+            ids = {user.get_id() for user in pending if user.get_id() != None}
+            posting.update(ids)
+
+            #requests are throttled by the rate limiter and the concurrency controller of the orbit instance
+            tasks = [asyncio.ensure_future(self.orbit.async_add_member(session,user)) for user in pending]
+            try:
                 response = await asyncio.gather(*tasks)
-                logging.info(f'Insertion of batch {lower+1}-{lower+len(sub_batch)} into Orbit has completed.')
-                
-                #checking whether the current loop is the final (no timeout needed then)
-                final_loop = lower + rate_limit >= len(batch)
-                if not final_loop:
-                    sleep = asyncio.create_task(set_timeout(timeout))
-                processor = asyncio.create_task(stream_batch(response))
-
-                #awaiting futures to complete
-                await processor
-                logging.info(f'Processing of batch {lower+1}-{lower+len(sub_batch)} has completed.')
-                if not final_loop:
-                    await sleep
-                
-                lower+=rate_limit
+            finally:
+                posting.difference_update(ids)
+
+            enriched = {user.get_id(): row for user, row in zip(pending, response) if row != None}
+            if self.cache != None:
+                self.cache.put({key: row['orbit'] for key, row in enriched.items()})
+            #the content of a user is only recorded once Orbit has accepted it
+            if self.changes != None:
+                self.changes.mark([user for user, row in zip(pending, response) if row != None])
+            if self.journal != None:
+                self.journal.mark_posted({key: row['orbit'] for key, row in enriched.items()})
+                self.journal.mark_failed([user.get_id() for user, row in zip(pending, response) if row == None])
+
+            #journaled and cached responses are ingested without posting the users to Orbit
+            reused = {**posted, **cached}
+            for user in unique.values():
+                if user.get_id() in reused:
+                    row = {"bigquery": user.to_dict(), "orbit": reused[user.get_id()]}
+                    response.append(row)
+                    enriched[user.get_id()] = row
+            return response, list(enriched.keys())
+
+        async def ingest(response, enriched, number, label):
+            """
+            streams a batch into BigQuery and marks its users as done in the journal, if one is attached.
+            """
+            started = time.perf_counter()
+            metrics.add('ingestions_in_flight', 1)
+            try:
+                errors = await self.stream_batch(response, number, executor, staging)
+            finally:
+                metrics.add('ingestions_in_flight', -1)
+            metrics.observe('ingest_seconds', time.perf_counter() - started)
+            self.errors += errors
+            #users are only finished once they have been ingested without errors, staged users once the run is written
+            if self.journal != None and errors == 0:
+                if len(staging) > 0:
+                    staged.extend(enriched)
+                else:
+                    self.journal.mark_done(enriched)
+            logging.info(f'Processing of batch {label} has completed.')
+
+        async def window(session, sub_batch, number, label):
+            """
+            posts a sub batch to Orbit and ingests it once all of its requests have completed.
+            """
+            logging.info(f'Now starting to insert users from batch {label} into Orbit...')
+            started = time.perf_counter()
+            response, enriched = await add_members(session, sub_batch)
+            metrics.observe('orbit_batch_seconds', time.perf_counter() - started)
+            metrics.inc('users_processed_total', len(sub_batch))
+            logging.info(f'Insertion of batch {label} into Orbit has completed.')
+            async with ingestion_slots:
+                await ingest(response, enriched, number, label)
+
+        def produce(users, queue, loop):
+            """
+            iterates the users in a worker thread and feeds them into the bounded queue. As putting into a full
+            queue blocks the thread, the users are only pulled from the source as fast as they are processed.
+            """
+            try:
+                for user in users:
+                    if stop.is_set():
+                        break
+                    asyncio.run_coroutine_threadsafe(queue.put(user), loop).result()
+            finally:
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+        async def next_batch(queue):
+            """
+            takes up to batch_size users from the queue. Returns an empty list once the source is exhausted.
+            """
+            sub_batch = []
+            while len(sub_batch) < batch_size:
+                user = await queue.get()
+                if user is None:
+                    #put the sentinel back so that subsequent calls return immediately
+                    queue.put_nowait(None)
+                    break
+                sub_batch.append(user)
+            metrics.set('queue_depth', queue.qsize())
+            return sub_batch
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize = queue_size)
+        stop = threading.Event()
+        producer = loop.run_in_executor(None, produce, batch, queue, loop)
+        #BigQuery inserts are executed by a pool of writer threads that share one client
+        executor = self.executor if self.executor != None else ThreadPoolExecutor(max_workers = 4)
+        ingestion_slots = asyncio.Semaphore(max_ingestions)
+        #ids of the users whose requests are in flight in any window
+        posting = set()
+        windows = set()
+        #staging tables of the run by table and the ids of the users that wait for the merge of the run
+        staging, staged = {}, []
+        self.errors = 0
+
+        try:
+            #all requests of the run share the long-lived session of the orbit instance
+            session = await self.orbit.open_session()
+            await self.open_staging(staging, executor)
+            lower = 0
+            number = 0 if self.journal == None else self.journal.next_batch()
+            while True:
+                sub_batch = await next_batch(queue)
+                if len(sub_batch) == 0:
+                    break
+                #the batch is posted and ingested in the background while the next batches are read and posted. The
+                #number of batches in progress is bounded, so that memory stays constant
+                windows.add(asyncio.create_task(window(session, sub_batch, number, f'{lower+1}-{lower+len(sub_batch)}')))
+                if len(windows) >= max_windows:
+                    done, windows = await asyncio.wait(windows, return_when = asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()
+
+                lower+=len(sub_batch)
+                number+=1
+
+            if len(windows) > 0:
+                await asyncio.gather(*windows)
+            errors = await self.commit_staging(staging, executor)
+            self.errors += errors
+            if self.journal != None and errors == 0:
+                self.journal.mark_done(staged)
+        finally:
+            #unblocks the producer in case processing was aborted
+            stop.set()
+            while not queue.empty():
+                queue.get_nowait()
+            for task in windows:
+                task.cancel()
+            await self.orbit.close_session()
+            await self.drop_staging(staging, executor)
+            if executor != self.executor:
+                executor.shutdown(wait = False)
+
+        #re-raises errors that occurred while reading from the source
+        await producer
+        return lower
+
+    async def open_staging(self, staging, executor):
+        """
+        creates a staging table for each table of JOBS in 'load' and 'upsert' mode and adds it to staging by table, so that
+        the sub batches of a run are written at once by commit_staging. The staging tables are created with the writer
+        threads of executor.
+        """
+        if self.write_options.get('mode', 'stream') not in ['load', 'upsert']:
+            return
+        loop = asyncio.get_running_loop()
+        for job in self.JOBS:
+            integrator = Integrator(job['table'], [], **self.write_options)
+            staging[job['table']] = {'name': await loop.run_in_executor(executor, integrator.create_staging), 'rows': 0}
+
+    async def commit_staging(self, staging, executor):
+        """
+        writes the staging tables that received rows into their tables with one MERGE (in 'upsert' mode) or copy job (in
+        'load' mode) per table and returns the number of errors that occurred.
+        """
+        async def commit(job):
+            table = staging.get(job['table'])
+            if table == None or table['rows'] == 0:
+                return 0
+            integrator = Integrator(job['table'], [], keys = job['keys'], staging = table['name'], **self.write_options)
+            await asyncio.get_running_loop().run_in_executor(executor, integrator.commit)
+            for error in integrator.errors:
+                logging.error(error)
+            logging.info(f"{table['rows']} rows of the run have been written into {job['table']}. {len(integrator.errors)} errors occurred.")
+            return len(integrator.errors)
+
+        return sum(await asyncio.gather(*[commit(job) for job in self.JOBS]))
+
+    async def drop_staging(self, staging, executor):
+        """
+        drops the staging tables of a run, which also runs if the run was aborted.
+        """
+        loop = asyncio.get_running_loop()
+        for table, entry in staging.items():
+            await loop.run_in_executor(executor, Integrator(table, [], **self.write_options).drop_staging, entry['name'])
+        staging.clear()
+
+    async def stream_batch(self, batch, number, executor, staging = None):
+        """
+        parses user responses and streams them into BigQuery with the writer threads of executor. Returns the number of
+        errors that occurred and records the insert status of each job in the journal, if one is attached. If staging
+        tables of the run are passed (see open_staging), the rows are appended to them instead.
+        """
+        #the whole batch is transformed into column oriented tables at once, rows of erroneous requests are skipped
+        started = time.perf_counter()
+        users, langs = self.transformer.transform(batch)
+        #load jobs take the columns as Arrow tables, streaming inserts require rows
+        if self.write_options.get('mode', 'stream') in ['load', 'upsert'] and pa != None:
+            users, langs = self.transformer.to_arrow(users), self.transformer.to_arrow(langs)
+        else:
+            users, langs = self.transformer.to_rows(users), self.transformer.to_rows(langs)
+        metrics.observe('transform_seconds', time.perf_counter() - started)
+
+        #declaring jobs for the data injection
+        jobs = [{**job, 'payload': payload} for job, payload in zip(self.JOBS, [users, langs])]
+        staging = staging if staging != None else {}
+
+        async def execute_job(job):
+            if len(job['payload']) == 0:
+                logging.info(f"Job '{job['name']} has empty payload. No call to BigQuery is made.")
+                return 0
+            logging.info(f"Executing Job '{job['name']}'...")
+            #the keys are only used by upserts
+            table = staging.get(job['table'])
+            integrator = Integrator(job['table'], job['payload'], keys = job['keys'], staging = table['name'] if table != None else None, **self.write_options)
+            #the insert runs in the writer pool so that Orbit requests continue in the meantime
+            await integrator.async_execute(executor)
+            if table != None and len(integrator.errors) == 0:
+                table['rows'] += len(job['payload'])
+            logging.info(f"Execution of Job '{job['name']}' has completed. {len(integrator.errors)} errors occurred.")
+            for error in integrator.errors:
+                logging.error(error)
+            if self.journal != None:
+                self.journal.mark_batch(number, job['name'], len(integrator.errors))
+            return len(integrator.errors)
+
+        #executing the injection
+        errors = await asyncio.gather(*[execute_job(job) for job in jobs])
+        return sum(errors)
 
     def execute(self, batch, **kwargs):
         """
         executes asynchronous Orbit calls and BigQuery streaming inserts 
-        by wrapping process_batch in asyncio event loop.
+        by wrapping process_batch in asyncio event loop. The rate of Orbit calls
+        is controlled by the rate limiter of the orbit instance.
+        """
+        batch_size = kwargs.get('batch_size', 120)
+        queue_size = kwargs.get('queue_size', 2 * batch_size)
+        max_ingestions = kwargs.get('max_ingestions', 2)
+        max_windows = kwargs.get('max_windows', 4)
+        return asyncio.run(self.process_batch(batch,batch_size,queue_size,max_ingestions,max_windows))
+
+    async def process_export(self, items, prefetch, max_ingestions):
+        """
+        exports all members of the Orbit workspace with Orbit.export_members and streams each page into BigQuery as
+        it arrives, which takes one request per page of up to items members instead of one request per member. The
+        inserts of up to max_ingestions pages overlap with the requests of the next pages. If a cache is attached, the
+        exported members replace the cached responses of the users. In 'load' and 'upsert' mode, the pages are written at
+        once when the export has completed. Returns the number of exported members, while the number of rows that could
+        not be written to BigQuery is kept in errors.
+        """
+        executor = self.executor if self.executor != None else ThreadPoolExecutor(max_workers = 4)
+        ingestions = set()
+        count = 0
+        staging = {}
+        self.errors = 0
+        try:
+            session = await self.orbit.open_session()
+            await self.open_staging(staging, executor)
+            number = 0 if self.journal == None else self.journal.next_batch()
+            async for members in self.orbit.export_members(session, items = items, prefetch = prefetch):
+                #pages are shaped like the responses of Orbit.async_add_member, exported members have no signup data
+                batch = [{"bigquery": {}, "orbit": {"data": member}} for member in members]
+                if self.cache != None:
+                    #members are cached by the id of User.get_id, so that enrichments reuse the exported state
+                    self.cache.put({self._member_id(row['orbit']['data']): row['orbit'] for row in batch})
+                ingestions.add(asyncio.create_task(self.stream_batch(batch, number, executor, staging)))
+                if len(ingestions) >= max_ingestions:
+                    done, ingestions = await asyncio.wait(ingestions, return_when = asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        self.errors += task.result()
+                count += len(members)
+                number += 1
+                metrics.inc('members_exported_total', len(members))
+                logging.info(f'{count} members have been exported so far.')
+            if len(ingestions) > 0:
+                self.errors += sum(await asyncio.gather(*ingestions))
+            self.errors += await self.commit_staging(staging, executor)
+        finally:
+            for task in ingestions:
+                task.cancel()
+            await self.orbit.close_session()
+            await self.drop_staging(staging, executor)
+            if executor != self.executor:
+                executor.shutdown(wait = False)
+        return count
+
+    @staticmethod
+    def _member_id(member):
+        """
+        returns the id of an Orbit member the way User.get_id derives it, i.e. its GitHub handle or else its email.
+        """
+        attributes = member.get('attributes') or {}
+        return attributes.get('github') if attributes.get('github') != None else attributes.get('email')
+
+    def export(self, **kwargs):
+        """
+        exports all members of the Orbit workspace into BigQuery by wrapping process_export in an asyncio event loop. The
+        number of members per page can be set in the 'items' keyword and the number of pages requested concurrently in
+        the 'prefetch' keyword.
         """
-        rate_limit = kwargs.get('limit', 120)
-        timeout = kwargs.get('timeout', 1)
-        asyncio.run(self.process_batch(batch,rate_limit,timeout))
\ No newline at end of file
+        items = kwargs.get('items', 100)
+        prefetch = kwargs.get('prefetch', 4)
+        max_ingestions = kwargs.get('max_ingestions', 2)
+        return asyncio.run(self.process_export(items, prefetch, max_ingestions))
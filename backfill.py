@@ -0,0 +1,105 @@
+import asyncio, itertools, logging, time, datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from data_clients import Accessor
+from async_manager import AsyncManager
+from journal import Journal
+
+class Backfill:
+    """
+    enriches the signups of a time range split into daily or hourly partitions. Up to 'concurrency' partitions are
+    enriched at the same time, while the queries of the next 'prefetch' partitions are already executed. All partitions
+    share the orbit instance and thereby its rate limiter and session, as well as one pool of 'writers' threads for the
+    BigQuery inserts. Further keywords for the AsyncManager of each partition (e.g. cache or write_options) can be passed
+    in 'manager_options' and for AsyncManager.process_batch in 'batch_size', 'queue_size' and 'max_ingestions'. If a
+    'journal_path' is passed, each partition is journaled as separate run in that journal.
+    """
+    def __init__(self, orbit, query, **kwargs):
+        self.orbit = orbit
+        self.query = query
+        self.granularity = kwargs.get('granularity', 'day')
+        self.concurrency = kwargs.get('concurrency', 4)
+        self.prefetch = kwargs.get('prefetch', 2)
+        self.writers = kwargs.get('writers', 4)
+        self.journal_path = kwargs.get('journal_path', None)
+        self.manager_options = kwargs.get('manager_options', {})
+        self.batch_size = kwargs.get('batch_size', 120)
+        self.queue_size = kwargs.get('queue_size', 2 * self.batch_size)
+        self.max_ingestions = kwargs.get('max_ingestions', 2)
+        self.stream_options = kwargs.get('stream_options', {'mode': 'arrow'})
+
+    @property
+    def granularity(self):
+        return self.__granularity
+
+    @granularity.setter
+    def granularity(self, granularity):
+        if granularity in ['day', 'hour']:
+            self.__granularity = granularity
+        else:
+            raise ValueError(f"Granularity must be either 'day' or 'hour', not {granularity}.")
+
+    def partitions(self, lower_limit, upper_limit):
+        """
+        splits [lower_limit, upper_limit) into a list of partitions, each a tuple of its lower (closed) and upper (open) bound.
+        """
+        step = dt.timedelta(days = 1) if self.granularity == 'day' else dt.timedelta(hours = 1)
+        lower = lower_limit if isinstance(lower_limit, dt.datetime) else dt.datetime(lower_limit.year, lower_limit.month, lower_limit.day)
+        upper = upper_limit if isinstance(upper_limit, dt.datetime) else dt.datetime(upper_limit.year, upper_limit.month, upper_limit.day)
+        partitions = []
+        while lower < upper:
+            partitions.append((lower, min(lower + step, upper)))
+            lower += step
+        return partitions
+
+    async def run(self, lower_limit, upper_limit):
+        """
+        enriches all partitions of [lower_limit, upper_limit) and returns a dictionary with the number of processed users
+        per partition.
+        """
+        partitions = self.partitions(lower_limit, upper_limit)
+        loop = asyncio.get_running_loop()
+        #partitions hold a prefetch slot from the start of their query until they are completed
+        prefetch_slots = asyncio.Semaphore(self.concurrency + self.prefetch)
+        run_slots = asyncio.Semaphore(self.concurrency)
+        progress = {'completed': 0, 'users': 0, 'started': time.monotonic()}
+
+        def prime(users):
+            #executes the query and downloads the first page, the remaining pages are read while the partition is enriched
+            first = next(users, None)
+            return users if first == None else itertools.chain([first], users)
+
+        async def enrich(lower, upper, executor):
+            label = f"{lower} - {upper}"
+            async with prefetch_slots:
+                accessor = Accessor(query = self.query)
+                accessor.filter_time(lower_limit = lower, upper_limit = upper)
+                users = await loop.run_in_executor(None, prime, accessor.stream(**self.stream_options))
+                async with run_slots:
+                    logging.info(f"Starting partition {label}...")
+                    started = time.monotonic()
+                    journal = Journal(self.journal_path, run = f"{lower}_{upper}") if self.journal_path != None else None
+                    manager = AsyncManager(self.orbit, executor = executor, journal = journal, **self.manager_options)
+                    try:
+                        count = await manager.process_batch(users, self.batch_size, self.queue_size, self.max_ingestions)
+                    finally:
+                        if journal != None:
+                            journal.close()
+            elapsed = time.monotonic() - started
+            progress['completed'] += 1
+            progress['users'] += count
+            total = time.monotonic() - progress['started']
+            logging.info(
+                f"Partition {label} has completed: {count} users in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.1f} users/s). "
+                f"{progress['completed']}/{len(partitions)} partitions and {progress['users']} users completed in {total:.1f}s."
+            )
+            return label, count
+
+        with ThreadPoolExecutor(max_workers = self.writers) as executor:
+            results = await asyncio.gather(*[enrich(lower, upper, executor) for lower, upper in partitions])
+        return dict(results)
+
+    def execute(self, lower_limit, upper_limit):
+        """
+        runs the backfill of [lower_limit, upper_limit) in an asyncio event loop.
+        """
+        return asyncio.run(self.run(lower_limit, upper_limit))
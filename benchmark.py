@@ -0,0 +1,442 @@
+import os, sys, json, time, random, asyncio, threading, argparse, logging, statistics, resource, datetime as dt
+from aiohttp import web
+from orbit import Orbit
+from rate_limiter import RateLimiter
+from retry import RetryPolicy
+from data_clients import Accessor
+from google.cloud import bigquery
+from async_manager import AsyncManager
+from transform import pa
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+class FakeOrbit:
+    """
+    local stand-in for the members endpoint of the Orbit API (/api/v1/{workspace}/members), which runs an aiohttp server
+    in a background thread. Each response is delayed by 'latency' seconds, varied by up to 'jitter' of the latency in
+    either direction, and fails with status 500 at the probability 'error_rate'. If 'limit' is set, at most 'limit'
+    requests are accepted per 'period' seconds and the remaining ones are rejected with status 429, a 'Retry-After'
+    header and the rate limit headers that Orbit sends. The members list serves 'members' generated members, single
+    members can be retrieved and deleted by id. Pass the url to Orbit as 'base_url'.
+    """
+    def __init__(self, **kwargs):
+        self.latency = kwargs.get('latency', 0.05)
+        self.jitter = kwargs.get('jitter', 0.5)
+        self.error_rate = kwargs.get('error_rate', 0)
+        self.limit = kwargs.get('limit', None)
+        self.period = kwargs.get('period', 1)
+        self.port = kwargs.get('port', 0)
+        self.members = kwargs.get('members', 0)
+        self.requests, self.throttled, self.errors = 0, 0, 0
+        self.window, self.window_requests = time.monotonic(), 0
+        self.loop, self.runner, self.thread = None, None, None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}/api/v1/"
+
+    def _throttle(self):
+        """
+        counts the request in the current fixed window and returns the rate limit headers as well as whether the request
+        exceeds the limit.
+        """
+        now = time.monotonic()
+        if now - self.window >= self.period:
+            self.window, self.window_requests = now, 0
+        self.window_requests += 1
+        reset = self.period - (now - self.window)
+        headers = {
+            'X-RateLimit-Limit': str(self.limit),
+            'X-RateLimit-Remaining': str(max(0, self.limit - self.window_requests)),
+            'X-RateLimit-Reset': f"{reset:.3f}"
+        }
+        if self.window_requests > self.limit:
+            headers['Retry-After'] = f"{reset:.3f}"
+            return headers, True
+        return headers, False
+
+    async def respond(self, body, status):
+        """
+        returns body with status after the latency, unless the request is throttled or fails at random.
+        """
+        self.requests += 1
+        headers, throttled = self._throttle() if self.limit != None else ({}, False)
+        if throttled:
+            self.throttled += 1
+            return web.json_response({'errors': 'rate limit exceeded'}, status = 429, headers = headers)
+        await asyncio.sleep(max(0, self.latency * (1 + random.uniform(-self.jitter, self.jitter))))
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({'errors': 'internal server error'}, status = 500, headers = headers)
+        return web.json_response(body, status = status, headers = headers)
+
+    async def add_member(self, request):
+        member = (await request.json())['member']
+        return await self.respond(self.member(member), 201)
+
+    async def list_members(self, request):
+        page, items = int(request.query.get('page', 1)), int(request.query.get('items', 10))
+        indexes = range((page - 1) * items, min(page * items, self.members))
+        members = [self.member({'github': f"user{index}", 'email': f"user{index}@example.org"})['data'] for index in indexes]
+        last = max(1, -(-self.members // items))
+        links = {
+            'first': f"{request.url.with_query(page = 1, items = items)}",
+            'last': f"{request.url.with_query(page = last, items = items)}",
+            'next': f"{request.url.with_query(page = page + 1, items = items)}" if page < last else None
+        }
+        return await self.respond({'data': members, 'links': links}, 200)
+
+    async def get_member(self, request):
+        return await self.respond(self.member({'github': request.match_info['id']}), 200)
+
+    async def delete_member(self, request):
+        self.requests += 1
+        return web.Response(status = 204)
+
+    @staticmethod
+    def member(member):
+        """
+        returns the body Orbit responds with for a posted member.
+        """
+        github = member.get('github') or member.get('email') or 'anonymous'
+        attributes = {key: None for key in Orbit.DEFAULT_KEYS}
+        attributes.update({
+            'github': member.get('github'),
+            'name': member.get('name'),
+            'email': member.get('email'),
+            'company': 'Gitpod',
+            'location': 'Kiel, Germany',
+            'love': '1.5',
+            'orbit_level': 3,
+            'activities_count': 12,
+            'reach': 4,
+            'github_followers': 42,
+            'languages': ['Python', 'Go', 'TypeScript'][:len(github) % 3 + 1]
+        })
+        return {'data': {'id': github, 'type': 'member', 'attributes': attributes}}
+
+    def start(self):
+        """
+        starts the server in a background thread and returns once it accepts connections.
+        """
+        app = web.Application()
+        app.router.add_post('/api/v1/{workspace}/members', self.add_member)
+        app.router.add_get('/api/v1/{workspace}/members', self.list_members)
+        app.router.add_get('/api/v1/{workspace}/members/{id}', self.get_member)
+        app.router.add_delete('/api/v1/{workspace}/members/{id}', self.delete_member)
+        self.loop = asyncio.new_event_loop()
+        self.runner = web.AppRunner(app, access_log = None)
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.runner.setup())
+            site = web.TCPSite(self.runner, '127.0.0.1', self.port)
+            self.loop.run_until_complete(site.start())
+            self.port = self.runner.addresses[0][1]
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target = run, daemon = True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+class FakeBigQuery:
+    """
+    in-memory replacement of the bigquery.Client used by Accessor and Integrator. Every query returns 'users' generated
+    signups, which are served in pages or as Arrow record batches, and is recorded in queries. Streaming inserts and load
+    jobs take 'insert_latency' seconds and the number of rows written is counted per table in rows. Copy jobs add the rows
+    of the source table to the destination table, the number of load jobs is counted per table in loads.
+    """
+    def __init__(self, **kwargs):
+        self.users = kwargs.get('users', 1000)
+        self.insert_latency = kwargs.get('insert_latency', 0)
+        self.rows = {}
+        self.loads = {}
+        self.queries = []
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        #the client is pickled when it is passed to the workers of a ShardedManager
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def signups(self, lower, upper):
+        created_at = dt.datetime(2021, 6, 28, tzinfo = dt.timezone.utc)
+        return [
+            {
+                'email': f"user{index}@example.org",
+                'name': f"User {index}",
+                'github': f"user{index}",
+                'created_at': created_at + dt.timedelta(seconds = index)
+            }
+            for index in range(lower, min(upper, self.users))
+        ]
+
+    def query(self, query, job_config = None):
+        with self.lock:
+            self.queries.append(query)
+        return _FakeQueryJob(self)
+
+    def get_table(self, table):
+        return bigquery.Table(table, schema = [])
+
+    def create_table(self, table):
+        return table
+
+    def delete_table(self, table, not_found_ok = False):
+        with self.lock:
+            self.rows.pop(table, None)
+
+    def _written(self, table, count):
+        time.sleep(self.insert_latency)
+        with self.lock:
+            self.rows[table] = self.rows.get(table, 0) + count
+
+    def copy_table(self, source, destination, job_config = None):
+        with self.lock:
+            self.rows[destination] = self.rows.get(destination, 0) + self.rows.get(source, 0)
+        return _FakeLoadJob()
+
+    def insert_rows_json(self, table, rows, row_ids = None):
+        self._written(table, len(rows))
+        return []
+
+    def load_table_from_file(self, buffer, table, job_config = None):
+        if job_config != None and job_config.source_format == 'PARQUET':
+            count = pq.read_table(buffer).num_rows
+        else:
+            count = len(buffer.getvalue().splitlines())
+        with self.lock:
+            self.loads[table] = self.loads.get(table, 0) + 1
+        self._written(table, count)
+        return _FakeLoadJob()
+
+class _FakeQueryJob:
+    def __init__(self, client):
+        self.client = client
+
+    def result(self, page_size = 1000):
+        return _FakeRowIterator(self.client, page_size)
+
+class _FakeRowIterator:
+    def __init__(self, client, page_size):
+        self.client = client
+        self.page_size = page_size
+        self.total_rows = client.users
+
+    @property
+    def pages(self):
+        for lower in range(0, self.total_rows, self.page_size):
+            yield self.client.signups(lower, lower + self.page_size)
+
+    def to_arrow_iterable(self, bqstorage_client = None):
+        for page in self.pages:
+            yield pa.RecordBatch.from_pylist(page)
+
+class _FakeLoadJob:
+    errors = None
+
+    def result(self):
+        return self
+
+def _rss():
+    """
+    returns the resident set size of the process in bytes. Where procfs is not available, the peak resident set size is
+    returned instead.
+    """
+    try:
+        with open('/proc/self/statm') as infile:
+            return int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == 'darwin' else usage * 1024
+
+class Measurement:
+    """
+    measures the duration, the latencies of the Orbit calls and the peak resident set size of a benchmark run. The RSS is
+    sampled every 'interval' seconds by a background thread while the measurement is entered.
+    """
+    def __init__(self, interval = 0.01):
+        self.interval = interval
+        self.latencies = []
+        self.failed = 0
+        self.peak_rss = 0
+        self.seconds = 0
+
+    def timed(self, function):
+        """
+        wraps an Orbit call (synchronous or asynchronous) so that its latency, including rate limiting and retries, and
+        its failure are recorded.
+        """
+        def record(started, response):
+            self.latencies.append(time.perf_counter() - started)
+            if not response:
+                self.failed += 1
+            return response
+
+        if asyncio.iscoroutinefunction(function):
+            async def wrapper(*args):
+                started = time.perf_counter()
+                return record(started, await function(*args))
+        else:
+            def wrapper(*args):
+                started = time.perf_counter()
+                return record(started, function(*args))
+        return wrapper
+
+    def __enter__(self):
+        self.stopped = threading.Event()
+        self.peak_rss = _rss()
+
+        def sample():
+            while not self.stopped.wait(self.interval):
+                self.peak_rss = max(self.peak_rss, _rss())
+
+        self.sampler = threading.Thread(target = sample, daemon = True)
+        self.sampler.start()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.perf_counter() - self.started
+        self.stopped.set()
+        self.sampler.join()
+        self.peak_rss = max(self.peak_rss, _rss())
+
+    def result(self, **kwargs):
+        """
+        returns the results of the run as dictionary, extended by the passed keywords.
+        """
+        #quantiles requires at least two data points
+        quantiles = statistics.quantiles(self.latencies, n = 100) if len(self.latencies) > 1 else [None] * 99
+        return {
+            **kwargs,
+            'users': len(self.latencies),
+            'failed': self.failed,
+            'seconds': round(self.seconds, 3),
+            'users_per_second': round(len(self.latencies) / self.seconds, 1) if self.seconds > 0 else None,
+            'p50': round(quantiles[49], 4) if quantiles[49] != None else None,
+            'p99': round(quantiles[98], 4) if quantiles[98] != None else None,
+            'peak_rss_mb': round(self.peak_rss / 2**20, 1)
+        }
+
+def _orbit(server, limit, **kwargs):
+    """
+    creates an Orbit instance for the fake server whose limiter grants 'limit' requests per second. The retry delays are
+    shortened, so that errors of the fake server do not dominate the run time.
+    """
+    return Orbit(
+        "benchmark", "gitpod",
+        base_url = server.url,
+        limiter = RateLimiter(limit = limit, period = 1),
+        retry = RetryPolicy(base = kwargs.get('retry_base', 0.05), cap = kwargs.get('retry_cap', 1)),
+        connections = kwargs.get('connections', 100),
+        pool_size = kwargs.get('pool_size', 10)
+    )
+
+def benchmark_async_manager(server, users, batch_size, limit, **kwargs):
+    """
+    streams 'users' signups from the fake BigQuery client through AsyncManager.execute against the fake Orbit server and
+    returns the results of the run. The keyword 'write_mode' sets the mode of the Integrator and 'stream_mode' the mode
+    of Accessor.stream.
+    """
+    client = FakeBigQuery(users = users, insert_latency = kwargs.get('insert_latency', 0))
+    orbit = _orbit(server, limit, **kwargs)
+    accessor = Accessor(query = "SELECT * FROM signups", client = client)
+    manager = AsyncManager(orbit, write_options = {'client': client, 'mode': kwargs.get('write_mode', 'stream')})
+    with Measurement() as measurement:
+        orbit.async_add_member = measurement.timed(orbit.async_add_member)
+        manager.execute(accessor.stream(mode = kwargs.get('stream_mode', 'arrow'), min_arrow_rows = 0), batch_size = batch_size)
+    orbit.close()
+    return measurement.result(benchmark = 'AsyncManager.execute', batch_size = batch_size, limit = limit)
+
+def benchmark_batch_job(server, users, batch_size, limit, **kwargs):
+    """
+    posts 'users' signups of the fake BigQuery client with Orbit.batch_job in batches of batch_size users against the fake
+    Orbit server and returns the results of the run.
+    """
+    client = FakeBigQuery(users = users)
+    orbit = _orbit(server, limit, **kwargs)
+    batch = list(Accessor(query = "SELECT * FROM signups", client = client).stream())
+    with Measurement() as measurement:
+        add_member = measurement.timed(orbit.add_member)
+        for lower in range(0, len(batch), batch_size):
+            orbit.batch_job(add_member, batch[lower:lower + batch_size])
+    orbit.close()
+    return measurement.result(benchmark = 'Orbit.batch_job', batch_size = batch_size, limit = limit)
+
+def run(**kwargs):
+    """
+    runs both benchmarks for every combination of 'batch_sizes' and 'limits' against one fake Orbit server and returns the
+    list of results. Further keywords configure the fake server and the benchmarks.
+    """
+    server_options = ['latency', 'jitter', 'error_rate']
+    options = {key: value for key, value in kwargs.items() if key not in ['users', 'batch_sizes', 'limits']}
+    results = []
+    with FakeOrbit(limit = kwargs.get('server_limit', None), **{key: kwargs[key] for key in server_options if key in kwargs}) as server:
+        for limit in kwargs.get('limits', [100, 1000]):
+            for batch_size in kwargs.get('batch_sizes', [60, 120, 240]):
+                for benchmark in [benchmark_async_manager, benchmark_batch_job]:
+                    result = benchmark(server, kwargs.get('users', 1000), batch_size, limit, **options)
+                    logging.info(f"{result}")
+                    results.append(result)
+    return results
+
+def report(results):
+    """
+    returns the results as aligned table.
+    """
+    columns = ['benchmark', 'batch_size', 'limit', 'users', 'failed', 'seconds', 'users_per_second', 'p50', 'p99', 'peak_rss_mb']
+    def format(value):
+        return f"{value:.4f}" if isinstance(value, float) and value < 1 else str(value)
+    rows = [columns] + [[format(result[column]) for column in columns] for result in results]
+    widths = [max(len(row[index]) for row in rows) for index in range(len(columns))]
+    return "\n".join("  ".join(value.ljust(width) for value, width in zip(row, widths)) for row in rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'benchmarks the enrichment against a local fake Orbit server and an in-memory BigQuery client')
+    parser.add_argument('--users', type = int, default = 1000)
+    parser.add_argument('--batch-sizes', type = int, nargs = '+', default = [60, 120, 240])
+    parser.add_argument('--limits', type = float, nargs = '+', default = [100, 1000], help = 'requests per second granted by the rate limiter')
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'latency of the fake Orbit server in seconds')
+    parser.add_argument('--error-rate', type = float, default = 0, help = 'probability of a 500 response')
+    parser.add_argument('--server-limit', type = int, help = 'requests per second the fake Orbit server accepts before responding with 429')
+    parser.add_argument('--write-mode', default = 'stream', choices = ['stream', 'load', 'upsert'])
+    parser.add_argument('--output', help = 'file the results are written to as JSON')
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.WARNING)
+    results = run(
+        users = args.users,
+        batch_sizes = args.batch_sizes,
+        limits = args.limits,
+        latency = args.latency,
+        error_rate = args.error_rate,
+        server_limit = args.server_limit,
+        write_mode = args.write_mode
+    )
+    print(report(results))
+    if args.output != None:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent = 2)
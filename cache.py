@@ -0,0 +1,65 @@
+import sqlite3, json, threading, time
+
+class ResponseCache:
+    """
+    persistent SQLite cache of Orbit member responses keyed by User.get_id. Entries expire after 'ttl' seconds and the least
+    recently used entries are evicted once the cache holds more than 'max_entries' responses.
+    """
+    def __init__(self, path = 'cache.db', **kwargs):
+        self.path = path
+        self.ttl = kwargs.get('ttl', 7 * 24 * 60 * 60)
+        self.max_entries = kwargs.get('max_entries', 100000)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses (id TEXT PRIMARY KEY, response TEXT, stored_at REAL, accessed_at REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    @property
+    def ttl(self):
+        return self.__ttl
+
+    @ttl.setter
+    def ttl(self, ttl):
+        if isinstance(ttl, (int, float)) and ttl >= 0:
+            self.__ttl = ttl
+        else:
+            raise ValueError(f"'ttl' must be a non-negative number, not {ttl}.")
+
+    def get(self, ids, **kwargs):
+        """
+        returns a dictionary with the cached responses of the passed ids. Responses older than the ttl are ignored unless a
+        different maximum age in seconds is passed in the 'max_age' keyword (None disables expiry).
+        """
+        ids = [x for x in set(ids) if x != None]
+        if len(ids) == 0:
+            return {}
+        max_age = kwargs.get('max_age', self.ttl)
+        now = time.time()
+        oldest = 0 if max_age == None else now - max_age
+        query = "SELECT id, response FROM responses WHERE stored_at >= ? AND id IN (" + ",".join("?" * len(ids)) + ")"
+        with self.lock, self.connection:
+            rows = self.connection.execute(query, [oldest, *ids]).fetchall()
+            self.connection.executemany("UPDATE responses SET accessed_at = ? WHERE id = ?", [(now, row[0]) for row in rows])
+        return {row[0]: json.loads(row[1]) for row in rows}
+
+    def put(self, responses):
+        """
+        stores the responses passed as dictionary of id and response and evicts the least recently used entries.
+        """
+        now = time.time()
+        rows = [(key, json.dumps(value), now, now) for key, value in responses.items() if key != None]
+        if len(rows) == 0:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO responses (id, response, stored_at, accessed_at) VALUES (?, ?, ?, ?)", rows)
+            count = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute(
+                    "DELETE FROM responses WHERE id IN (SELECT id FROM responses ORDER BY accessed_at ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+    def close(self):
+        self.connection.close()
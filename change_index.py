@@ -0,0 +1,48 @@
+import sqlite3, json, threading, time, hashlib
+
+class ChangeIndex:
+    """
+    persistent SQLite index of a content hash of User.to_dict keyed by User.get_id. It records the state of each user at
+    its last successful enrichment, so that users whose attributes have not changed since do not have to be posted to
+    Orbit again.
+    """
+    def __init__(self, path = 'changes.db'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS hashes (id TEXT PRIMARY KEY, hash TEXT, marked_at REAL)")
+
+    @staticmethod
+    def digest(user):
+        """
+        returns the content hash of a user.
+        """
+        return hashlib.blake2b(json.dumps(user.to_dict(), sort_keys = True).encode('utf-8'), digest_size = 16).hexdigest()
+
+    def unchanged(self, users):
+        """
+        returns the set of ids of the passed users whose content is the same as at their last successful enrichment.
+        """
+        digests = {user.get_id(): self.digest(user) for user in users if user.get_id() != None}
+        if len(digests) == 0:
+            return set()
+        query = "SELECT id, hash FROM hashes WHERE id IN (" + ",".join("?" * len(digests)) + ")"
+        with self.lock:
+            rows = self.connection.execute(query, list(digests.keys())).fetchall()
+        return {key for key, digest in rows if digests[key] == digest}
+
+    def mark(self, users):
+        """
+        records the current content of the passed users, which should only be called once they have been enriched.
+        """
+        now = time.time()
+        rows = [(user.get_id(), self.digest(user), now) for user in users if user.get_id() != None]
+        if len(rows) == 0:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO hashes (id, hash, marked_at) VALUES (?, ?, ?)", rows)
+
+    def close(self):
+        self.connection.close()
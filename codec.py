@@ -0,0 +1,91 @@
+import json
+from typing import Any, Optional
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class JSONCodec:
+    """
+    encodes the members posted to Orbit and decodes the member responses with the fastest JSON library that is installed
+    (msgspec, orjson or the standard library), which can be overridden with the 'backend' keyword. If attribute names are
+    passed in the 'keys' keyword, decode_member only extracts these attributes of a member response. With msgspec, the
+    remaining attributes are skipped while parsing and never materialized as Python objects.
+    """
+    BACKENDS = ['msgspec', 'orjson', 'json']
+
+    def __init__(self, **kwargs):
+        default = 'msgspec' if msgspec != None else 'orjson' if orjson != None else 'json'
+        self.backend = kwargs.get('backend', default)
+        self.keys = kwargs.get('keys', None)
+        if self.backend == 'msgspec':
+            self.encoder = msgspec.json.Encoder()
+            self.decoder = msgspec.json.Decoder()
+            self.member_decoder = self._member_decoder(self.keys) if self.keys != None else self.decoder
+
+    @property
+    def backend(self):
+        return self.__backend
+
+    @backend.setter
+    def backend(self, backend):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Backend must be one of {self.BACKENDS}, not {backend}.")
+        if (backend == 'msgspec' and msgspec == None) or (backend == 'orjson' and orjson == None):
+            raise ImportError(f"{backend} is required to use the {backend} backend.")
+        self.__backend = backend
+
+    @staticmethod
+    def _member_decoder(keys):
+        """
+        returns a msgspec decoder for member responses that only parses the attributes in keys. Unknown fields are ignored
+        by msgspec and absent attributes default to None.
+        """
+        attributes = msgspec.defstruct('Attributes', [(key, Any, None) for key in keys])
+        data = msgspec.defstruct('Data', [('attributes', Optional[attributes], None)])
+        response = msgspec.defstruct('Response', [('data', Optional[data], None)])
+        return msgspec.json.Decoder(response)
+
+    def encode(self, obj):
+        """
+        returns obj encoded as JSON bytes.
+        """
+        if self.backend == 'msgspec':
+            return self.encoder.encode(obj)
+        if self.backend == 'orjson':
+            return orjson.dumps(obj)
+        return json.dumps(obj, separators = (',', ':')).encode('utf-8')
+
+    def decode(self, body):
+        """
+        returns the object encoded in the JSON body (bytes or string).
+        """
+        if self.backend == 'msgspec':
+            return self.decoder.decode(body)
+        if self.backend == 'orjson':
+            return orjson.loads(body)
+        return json.loads(body)
+
+    def decode_member(self, body):
+        """
+        decodes a member response and keeps only the attributes in keys. The response keeps the shape
+        {'data': {'attributes': {...}}} expected by ResponseTransformer and Orbit.parse_user_response.
+        """
+        if self.keys == None:
+            return self.decode(body)
+        if self.backend == 'msgspec':
+            response = self.member_decoder.decode(body)
+            if response.data == None or response.data.attributes == None:
+                return {}
+            return {'data': {'attributes': msgspec.structs.asdict(response.data.attributes)}}
+        response = self.decode(body)
+        attributes = (response.get('data') or {}).get('attributes')
+        if attributes == None:
+            return {}
+        return {'data': {'attributes': {key: attributes.get(key) for key in self.keys}}}
@@ -0,0 +1,113 @@
+import asyncio, collections, time, logging
+from metrics import metrics
+
+class ConcurrencyController:
+    """
+    limits the number of in-flight Orbit requests independently of the request rate and adapts the limit by additive
+    increase and multiplicative decrease (AIMD). While the recent latency (smoothed by 'smoothing') stays within the
+    threshold, every completed request raises the limit by 'increase' / limit, i.e. by 'increase' per round of requests,
+    up to 'maximum'. Until the first congestion, the limit grows by 'increase' per request instead (slow start), which
+    doubles it every round. Requests that time out or fail with an overload status ('congested', 502, 503 and 504 by
+    default), as well as a recent latency above the threshold, cut the limit by 'decrease' down to 'minimum', at most
+    once per round trip, so that a burst of slow responses only counts once. The threshold is 'target' seconds if
+    passed, otherwise 'tolerance' times the baseline latency, a long-term average smoothed by 'baseline_smoothing'.
+    Slots are handed out first come, first served.
+    """
+    def __init__(self, **kwargs):
+        self.minimum = kwargs.get('minimum', 1)
+        self.maximum = kwargs.get('maximum', 100)
+        self.limit = kwargs.get('initial', min(20, self.maximum))
+        self.increase = kwargs.get('increase', 1)
+        self.decrease = kwargs.get('decrease', 0.5)
+        self.target = kwargs.get('target', None)
+        self.tolerance = kwargs.get('tolerance', 2)
+        #429 responses are left to the rate limiter and other errors do not indicate an overloaded API
+        self.congested = set(kwargs.get('congested', [502, 503, 504]))
+        self.smoothing = kwargs.get('smoothing', 0.2)
+        #the baseline follows the latency slowly, so that a persistent shift is eventually accepted as the new normal
+        self.baseline_smoothing = kwargs.get('baseline_smoothing', 0.01)
+        self.latency, self.baseline = None, None
+        self.decreased = 0
+        self.slow_start = True
+        self.in_flight = 0
+        #the futures are created on the loop of each caller, so the controller is not bound to one event loop
+        self.waiters = collections.deque()
+
+    @property
+    def limit(self):
+        return self.__limit
+
+    @limit.setter
+    def limit(self, limit):
+        if isinstance(limit, (int, float)) and self.minimum <= limit <= self.maximum:
+            self.__limit = limit
+        else:
+            raise ValueError(f"'limit' must be a number between {self.minimum} and {self.maximum}, not {limit}.")
+
+    @property
+    def threshold(self):
+        """
+        returns the recent latency in seconds above which requests count as congested, or None while no latency was
+        observed.
+        """
+        if self.target != None:
+            return self.target
+        return self.baseline * self.tolerance if self.baseline != None else None
+
+    def _wake(self):
+        while len(self.waiters) > 0 and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            #waiters that were cancelled while queuing are skipped
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self):
+        """
+        waits until the number of in-flight requests is below the limit and takes a slot, which has to be returned with
+        release.
+        """
+        if self.in_flight < int(self.limit) and len(self.waiters) == 0:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            #a slot that was handed over right before the cancellation is passed on
+            if waiter.done() and not waiter.cancelled():
+                self.in_flight -= 1
+                self._wake()
+            raise
+
+    def release(self, status = None, latency = None):
+        """
+        returns a slot and adapts the limit to the status and latency of the request. If latency is None, the request was
+        not sent and the limit is left as is.
+        """
+        self.in_flight -= 1
+        if latency != None:
+            self._adapt(status, latency)
+        self._wake()
+
+    def _adapt(self, status, latency):
+        failed = status == None or status in self.congested
+        if not failed:
+            if self.latency == None:
+                self.latency, self.baseline = latency, latency
+            else:
+                self.latency += (latency - self.latency) * self.smoothing
+                self.baseline += (latency - self.baseline) * self.baseline_smoothing
+        threshold = self.threshold
+        now = time.monotonic()
+        if failed or (threshold != None and self.latency > threshold):
+            if now - self.decreased >= (self.latency or 0):
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.decreased = now
+                self.slow_start = False
+                logging.debug(f"Orbit requests are congested (status {status}, {latency:.3f}s). Reducing concurrency to {int(self.limit)}.")
+        else:
+            increase = self.increase if self.slow_start else self.increase / self.limit
+            self.limit = min(self.maximum, self.limit + increase)
+        metrics.set('orbit_concurrency_limit', int(self.limit))
@@ -1,11 +1,55 @@
-import warnings, datetime as dt, logging
+import warnings, datetime as dt, logging, threading, asyncio, json, io, time, uuid
+from concurrent.futures import ThreadPoolExecutor
 from user import User
+from metrics import metrics
 from google.cloud import bigquery
+from google.api_core.exceptions import GoogleAPICallError
+
+try:
+    import pyarrow as pa, pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
+_client, _read_client, _client_lock = None, None, threading.Lock()
+
+def get_client():
+    """
+    returns the BigQuery client that is shared by all Accessors and Integrators of the process. The client is
+    created on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client == None:
+            _client = bigquery.Client()
+        return _client
+
+def get_read_client():
+    """
+    returns the BigQuery Storage read client shared by all Accessors of the process, or None if the
+    google-cloud-bigquery-storage package is not installed. Results are then downloaded through the REST API.
+    """
+    global _read_client
+    if bigquery_storage == None:
+        return None
+    with _client_lock:
+        if _read_client == None:
+            _read_client = bigquery_storage.BigQueryReadClient()
+        return _read_client
 
 class Accessor:
     def __init__(self, **kwargs):
         self.query = kwargs.get('query', None)
         self.result = None
+        self.client = kwargs.get('client', None)
+        #parameters referenced in the query, which are passed to BigQuery separately from the query string
+        self.parameters = []
+        #latest created_at and id of the retrieved users, see filter_incremental
+        self.high_water_mark = None
     
     @property
     def query(self):
@@ -32,16 +76,133 @@ class Accessor:
         wraps the query of the BQJob in a time window. If 'column' is passed as keyword, the column passed as value will be
         used to filter time, else 'created_at' is taken as default. Pass a datetime in keyword 'lower_limit' and 'upper_limit'
         to select the lower (closed) bound and upper (open) bound of the time window. If no values are passed, 'lower_limit'
-        defaults to midnight yesterday and 'upper_limit' defaults to midnight today. 
+        defaults to midnight yesterday and 'upper_limit' defaults to midnight today. The limits are compared as 'TIMESTAMP'
+        unless the type of the column ('DATE' or 'DATETIME') is passed in keyword 'type', as BigQuery does not compare
+        timestamps with dates or datetimes.
         """
         column = kwargs.get('column', 'created_at')
+        type = kwargs.get('type', 'TIMESTAMP')
         today = dt.date.today()
         lower = kwargs.get('lower_limit', today - dt.timedelta(days = 1))
         upper = kwargs.get('upper_limit', today)
 
-        lower, upper = lower.strftime('%Y-%m-%d'), upper.strftime('%Y-%m-%d')
+        #the limits are passed as query parameters, so that BigQuery can prune partitions and reuse cached results
+        parameters = [
+            bigquery.ScalarQueryParameter('lower_limit', type, self._to_parameter(lower, type)),
+            bigquery.ScalarQueryParameter('upper_limit', type, self._to_parameter(upper, type))
+        ]
+        self.query = "SELECT * FROM (" + self.query + ") WHERE " + column + " >= @lower_limit AND " + column + " < @upper_limit"
+        self.parameters += parameters
+
+    def filter_incremental(self, mark, **kwargs):
+        """
+        wraps the query of the BQJob so that only users after the passed high-water mark are selected. The mark is a tuple of
+        created_at and id (User.get_id) as returned by Watermark.load; users with the same created_at are ordered by their id.
+        If the mark is None, the time window of filter_time is applied with the passed keywords instead. The keywords 'column'
+        and 'type' select the column and its type as in filter_time. While the users are streamed, the latest mark is kept
+        in high_water_mark, which should be persisted once the run has completed.
+        """
+        if mark == None:
+            self.filter_time(**kwargs)
+            return
+        column = kwargs.get('column', 'created_at')
+        type = kwargs.get('type', 'TIMESTAMP')
+        created_at, id = mark
+        parameters = [
+            bigquery.ScalarQueryParameter('mark_created_at', type, self._to_parameter(created_at, type)),
+            bigquery.ScalarQueryParameter('mark_id', 'STRING', id)
+        ]
+        #the first condition on the column alone allows BigQuery to prune partitions
+        self.query = (
+            "SELECT * FROM (" + self.query + ") WHERE " + column + " >= @mark_created_at"
+            " AND (" + column + " > @mark_created_at OR COALESCE(github, email) > @mark_id)"
+        )
+        self.parameters += parameters
+
+    @classmethod
+    def _to_parameter(cls, value, type):
+        """
+        converts a date or datetime into the value of a query parameter of type 'TIMESTAMP', 'DATETIME' or 'DATE'.
+        """
+        if type not in ['TIMESTAMP', 'DATETIME', 'DATE']:
+            raise ValueError(f"Type must be either 'TIMESTAMP', 'DATETIME' or 'DATE', not {type}.")
+        if type == 'DATE':
+            return value.date() if isinstance(value, dt.datetime) else value
+        if type == 'DATETIME':
+            timestamp = cls._to_timestamp(value)
+            #aware datetimes are compared in UTC
+            return timestamp.astimezone(dt.timezone.utc).replace(tzinfo = None)
+        return cls._to_timestamp(value)
+
+    @staticmethod
+    def _to_timestamp(value):
+        if isinstance(value, dt.datetime):
+            return value if value.tzinfo != None else value.replace(tzinfo = dt.timezone.utc)
+        return dt.datetime(value.year, value.month, value.day, tzinfo = dt.timezone.utc)
+
+    def _update_mark(self, users):
+        """
+        advances the high-water mark to the latest of the passed users.
+        """
+        marks = [(user.created_at, user.get_id() or '') for user in users if user.created_at is not None]
+        if len(marks) > 0:
+            latest = max(marks)
+            if self.high_water_mark == None or latest > self.high_water_mark:
+                self.high_water_mark = latest
+
+    def stream(self, **kwargs):
+        """
+        executes the query and yields one User per row while the result is downloaded page by page, so that
+        rows can be processed before the complete result has arrived. Only the columns 'email', 'name', 'github'
+        and 'created_at' are selected. The number of rows per page can be set with the 'page_size' keyword.
+        Pass 'arrow' in the 'mode' keyword to download the result as Arrow record batches, which are read in
+        parallel streams through the BigQuery Storage API if it is installed. Results with fewer rows than set
+        in the 'min_arrow_rows' keyword are still read page by page, as the setup of the streams does not pay off.
+        """
+        if self.query == None:
+            warnings.warn("BQJob contains no query to execute. Please attach a query.")
+            return
+        page_size = kwargs.get('page_size', 1000)
+        mode = kwargs.get('mode', 'rows')
+        min_arrow_rows = kwargs.get('min_arrow_rows', 10000)
+        client = self.client if self.client != None else get_client()
+        query = "SELECT email, name, github, created_at FROM (" + self.query + ")"
+        job_config = bigquery.QueryJobConfig(query_parameters = self.parameters)
+        started = time.perf_counter()
+        rows = client.query(query, job_config = job_config).result(page_size = page_size)
+        metrics.observe('accessor_query_seconds', time.perf_counter() - started)
+
+        if mode == 'arrow' and pa != None and rows.total_rows != None and rows.total_rows >= min_arrow_rows:
+            #an injected client comes without a matching read client, so the record batches are read through it
+            read_client = get_read_client() if self.client == None else None
+            started = time.perf_counter()
+            for batch in rows.to_arrow_iterable(bqstorage_client = read_client):
+                #the users of a record batch are validated at once
+                users = User.from_arrow(batch)
+                logging.debug(f"retrieved record batch of {len(users)} Users.")
+                self._update_mark(users)
+                self._record_page(users, started)
+                yield from users
+                started = time.perf_counter()
+            return
 
-        self.query = "SELECT * FROM (" + self.query + ") WHERE " + column + " >= \"" + lower + "\" AND " + column + " < \"" + upper + "\""
+        started = time.perf_counter()
+        for page in rows.pages:
+            #the users of a page are validated at once instead of row by row
+            users = User.from_rows(page)
+            logging.debug(f"retrieved page of {len(users)} Users.")
+            self._update_mark(users)
+            self._record_page(users, started)
+            yield from users
+            started = time.perf_counter()
+
+    @staticmethod
+    def _record_page(users, started):
+        """
+        records the time it took to download and validate a page, excluding the time the consumer spent on the previous page.
+        """
+        metrics.observe('accessor_page_seconds', time.perf_counter() - started)
+        metrics.inc('accessor_users_total', len(users))
 
     def execute(self):
         """
@@ -50,17 +211,34 @@ class Accessor:
         if self.query == None:
             warnings.warn("BQJob contains no query to execute. Please attach a query.")
         else:
-            client = bigquery.Client()
-            self.result = []
-            for row in client.query(self.query):
-                user = User(email = row['email'], name = row['name'], github = row['github'], created_at = row['created_at'])
-                logging.debug(f"retrieved User: {str(user)}.")
-                self.result.append(user)
+            self.result = list(self.stream())
 
 class Integrator:
-    def __init__(self, table, payload):
+    """
+    writes the payload into the table. In the default 'stream' mode, rows are sent as streaming inserts in chunks of at most
+    'max_rows' rows and 'max_bytes' bytes, of which up to 'workers' are sent in parallel. The 'load' mode writes the payload
+    in a single batch load job, which is cheaper for bulk runs but limited to a few thousand jobs per table and day, so it
+    should be paired with large payloads. The 'upsert' mode loads the payload into a staging table and merges it into the
+    table on the columns passed in 'keys' (['github'] by default), so that reruns update rows instead of duplicating them.
+    Rows with a NULL key are always inserted. The columns passed in 'preserve' (['signup_date'] by default, which exported
+    members do not have) keep their current value when the merged row leaves them NULL. Besides a list of rows, the payload can be an Arrow table, which is loaded
+    as Parquet in 'load' and 'upsert' mode. To write the payloads of a whole run at once, create a staging table with
+    create_staging, pass it in the 'staging' keyword of each Integrator, which then appends its payload to the staging
+    table, and call commit once the run has completed. It merges the staging table into the table in 'upsert' mode and
+    appends it with a single copy job in 'load' mode, so that the table only takes one job per run.
+    """
+    def __init__(self, table, payload, **kwargs):
         self.table = table
         self.payload = payload
+        self.client = kwargs.get('client', None)
+        self.mode = kwargs.get('mode', 'stream')
+        self.max_rows = kwargs.get('max_rows', 500)
+        self.max_bytes = kwargs.get('max_bytes', 9 * 1024 * 1024)
+        self.workers = kwargs.get('workers', 4)
+        self.keys = kwargs.get('keys', ['github'])
+        self.preserve = kwargs.get('preserve', ['signup_date'])
+        self.staging = kwargs.get('staging', None)
+        self.errors = []
 
     @property
     def table(self):
@@ -80,11 +258,22 @@ class Integrator:
 
     @payload.setter
     def payload(self, payload):
-        if isinstance(payload, list):
+        if isinstance(payload, list) or (pa != None and isinstance(payload, pa.Table)):
             self.__payload = payload
         else:
             self.__payload = []
-            warnings.warn(f"Payload must be passed as List, not {type(payload)}. Payload was set to [].")
+            warnings.warn(f"Payload must be passed as List or Arrow Table, not {type(payload)}. Payload was set to [].")
+
+    @property
+    def mode(self):
+        return self.__mode
+
+    @mode.setter
+    def mode(self, mode):
+        if mode in ['stream', 'load', 'upsert']:
+            self.__mode = mode
+        else:
+            raise ValueError(f"Mode must be either 'stream', 'load' or 'upsert', not {mode}.")
 
     @property
     def errors(self):
@@ -98,6 +287,185 @@ class Integrator:
             self.__errors = []
             warnings.warn(f"Errors must be passed as List, not {type(errors)}. Errors was set to [].")
     
+    def chunks(self):
+        """
+        splits the payload into chunks that stay within the row and byte limits of a streaming insert. Yields the offset of
+        each chunk in the payload together with the chunk.
+        """
+        rows = self.payload if isinstance(self.payload, list) else self.payload.to_pylist()
+        offset, chunk, size = 0, [], 0
+        for row in rows:
+            #two bytes for the separator and brackets of each row in the request body
+            row_size = len(json.dumps(row, default = str)) + 2
+            if len(chunk) > 0 and (len(chunk) >= self.max_rows or size + row_size > self.max_bytes):
+                yield offset, chunk
+                offset, chunk, size = offset + len(chunk), [], 0
+            chunk.append(row)
+            size += row_size
+        if len(chunk) > 0:
+            yield offset, chunk
+
+    def stream(self, client):
+        def insert(offset, chunk):
+            errors = client.insert_rows_json(self.table, chunk, row_ids=[None] * len(chunk))
+            #shift the row indices of the errors from the chunk to the payload
+            for error in errors:
+                if 'index' in error:
+                    error['index'] += offset
+            return errors
+
+        chunks = list(self.chunks())
+        if len(chunks) <= 1 or self.workers <= 1:
+            results = [insert(offset, chunk) for offset, chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers = min(self.workers, len(chunks))) as executor:
+                results = list(executor.map(lambda args: insert(*args), chunks))
+        return [error for errors in results for error in errors]
+
+    def load(self, client, table = None):
+        """
+        appends the payload to the table (or the passed table) in a single load job.
+        """
+        table = self.table if table == None else table
+        if isinstance(self.payload, list):
+            buffer = io.BytesIO("\n".join(json.dumps(row, default = str) for row in self.payload).encode('utf-8'))
+            source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+        else:
+            buffer = io.BytesIO()
+            pq.write_table(self.payload, buffer)
+            buffer.seek(0)
+            source_format = bigquery.SourceFormat.PARQUET
+        job_config = bigquery.LoadJobConfig(
+            source_format = source_format,
+            write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+        )
+        job = client.load_table_from_file(buffer, table, job_config = job_config)
+        try:
+            job.result()
+        except GoogleAPICallError as e:
+            logging.error(f"Load job into {table} failed: {e}")
+        return job.errors if job.errors != None else []
+
+    @property
+    def columns(self):
+        if isinstance(self.payload, list):
+            return list(self.payload[0].keys()) if len(self.payload) > 0 else []
+        return self.payload.column_names
+
+    def merge_query(self, staging, columns = None):
+        """
+        returns the MERGE statement that upserts the rows of the staging table into the table. Rows of the staging table
+        with the same keys are collapsed first, as a MERGE fails if several source rows match the same target row. The
+        columns of the payload are merged unless others are passed.
+        """
+        columns = self.columns if columns == None else columns
+        on = " AND ".join(f"T.`{key}` = S.`{key}`" for key in self.keys)
+        partition = ", ".join(f"`{key}`" for key in self.keys)
+        null_keys = " OR ".join(f"`{key}` IS NULL" for key in self.keys)
+        updates = ", ".join(
+            f"`{column}` = COALESCE(S.`{column}`, T.`{column}`)" if column in self.preserve else f"`{column}` = S.`{column}`"
+            for column in columns if column not in self.keys
+        )
+        return (
+            f"MERGE `{self.table}` T USING ("
+            f"SELECT * EXCEPT(_row) FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY {partition}) AS _row FROM `{staging}`) WHERE _row = 1 OR {null_keys}"
+            f") S ON {on}"
+            + (f" WHEN MATCHED THEN UPDATE SET {updates}" if len(updates) > 0 else "")
+            + f" WHEN NOT MATCHED THEN INSERT ({', '.join(f'`{column}`' for column in columns)})"
+            f" VALUES ({', '.join(f'S.`{column}`' for column in columns)})"
+        )
+
+    def create_staging(self):
+        """
+        creates an empty staging table with the schema of the table and returns its name. The staging table expires after
+        a day in case it cannot be dropped.
+        """
+        client = self.client if self.client != None else get_client()
+        staging = f"{self.table}_staging_{uuid.uuid4().hex}"
+        table = bigquery.Table(staging, schema = client.get_table(self.table).schema)
+        table.expires = dt.datetime.now(dt.timezone.utc) + dt.timedelta(days = 1)
+        client.create_table(table)
+        return staging
+
+    def drop_staging(self, staging):
+        client = self.client if self.client != None else get_client()
+        try:
+            client.delete_table(staging, not_found_ok = True)
+        except GoogleAPICallError as e:
+            logging.warning(f"Staging table {staging} could not be dropped: {e}")
+
+    def merge(self, client, staging):
+        """
+        merges the staging table into the table. Without a payload, all columns of the staging table are merged.
+        """
+        columns = None if len(self.payload) > 0 else [field.name for field in client.get_table(staging).schema]
+        client.query(self.merge_query(staging, columns)).result()
+
+    def upsert(self, client):
+        """
+        loads the payload into a staging table with the schema of the table, merges it into the table and drops the
+        staging table.
+        """
+        staging = None
+        try:
+            staging = self.create_staging()
+            errors = self.load(client, staging)
+            if len(errors) > 0:
+                return errors
+            self.merge(client, staging)
+            return []
+        except GoogleAPICallError as e:
+            logging.error(f"Upsert into {self.table} failed: {e}")
+            return [{'message': str(e)}]
+        finally:
+            if staging != None:
+                self.drop_staging(staging)
+
+    def copy(self, client, staging):
+        """
+        appends the staging table to the table in a copy job.
+        """
+        job_config = bigquery.CopyJobConfig(write_disposition = bigquery.WriteDisposition.WRITE_APPEND)
+        client.copy_table(staging, self.table, job_config = job_config).result()
+
+    def commit(self):
+        """
+        writes the rows appended to the staging table during a run into the table, by a MERGE in 'upsert' mode and a copy
+        job in 'load' mode. The staging table is left for drop_staging.
+        """
+        client = self.client if self.client != None else get_client()
+        started = time.perf_counter()
+        try:
+            if self.mode == 'upsert':
+                self.merge(client, self.staging)
+            else:
+                self.copy(client, self.staging)
+            self.errors = []
+        except GoogleAPICallError as e:
+            logging.error(f"Commit of {self.staging} into {self.table} failed: {e}")
+            self.errors = [{'message': str(e)}]
+        metrics.observe('bigquery_commit_seconds', time.perf_counter() - started, table = self.table, mode = self.mode)
+        metrics.inc('bigquery_insert_errors_total', len(self.errors), table = self.table)
+
     def execute(self):
-        client = bigquery.Client()
-        self.errors = client.insert_rows_json(self.table, self.payload, row_ids=[None] * len(self.payload))
\ No newline at end of file
+        client = self.client if self.client != None else get_client()
+        started = time.perf_counter()
+        if self.mode in ['load', 'upsert'] and self.staging != None:
+            #the payload is written with the rest of the run by commit
+            self.errors = self.load(client, self.staging)
+        elif self.mode == 'load':
+            self.errors = self.load(client)
+        elif self.mode == 'upsert':
+            self.errors = self.upsert(client)
+        else:
+            self.errors = self.stream(client)
+        metrics.observe('bigquery_insert_seconds', time.perf_counter() - started, table = self.table, mode = self.mode)
+        metrics.inc('bigquery_rows_total', len(self.payload), table = self.table)
+        metrics.inc('bigquery_insert_errors_total', len(self.errors), table = self.table)
+
+    async def async_execute(self, executor = None):
+        """
+        runs execute in a thread of the passed executor (the default executor of the event loop if None), so that the
+        event loop is not blocked while the rows are inserted.
+        """
+        await asyncio.get_running_loop().run_in_executor(executor, self.execute)
@@ -0,0 +1,62 @@
+import os, json, logging, threading, datetime as dt
+from user import User
+
+class DeadLetterStore:
+    """
+    append-only JSON lines file that collects users whose Orbit request failed permanently or ran out of retries, so that
+    only the failures have to be reprocessed.
+    """
+    def __init__(self, path = 'dead_letter.jsonl'):
+        self.path = path
+        self.lock = threading.Lock()
+
+    @property
+    def replay_path(self):
+        return self.path + '.replay'
+
+    def add(self, user, status, error):
+        """
+        records the failed user together with the status (None if no response was received) and error of the last attempt.
+        """
+        letter = {
+            "user": user.to_dict(),
+            "status": status,
+            "error": error,
+            "failed_at": dt.datetime.now(dt.timezone.utc).isoformat()
+        }
+        with self.lock:
+            with open(self.path, 'a') as outfile:
+                outfile.write(json.dumps(letter) + "\n")
+
+    def replay(self):
+        """
+        moves the current dead letters aside and yields them as users. Failures that occur during the replay are recorded in
+        a fresh store. The moved letters are kept until complete_replay is called, so that an aborted replay can be resumed.
+        """
+        with self.lock:
+            if os.path.exists(self.path):
+                with open(self.path) as infile, open(self.replay_path, 'a') as outfile:
+                    outfile.write(infile.read())
+                os.remove(self.path)
+        if not os.path.exists(self.replay_path):
+            logging.info("No dead letters to replay.")
+            return
+        with open(self.replay_path) as infile:
+            for line in infile:
+                if line.strip() == "":
+                    continue
+                user = json.loads(line)['user']
+                created_at = user.get('created_at', None)
+                yield User(
+                    email = user.get('email', None),
+                    name = user.get('name', None),
+                    github = user.get('github', None),
+                    created_at = dt.datetime.fromisoformat(created_at) if created_at != None else None
+                )
+
+    def complete_replay(self):
+        """
+        removes the replayed letters once their users have been processed.
+        """
+        if os.path.exists(self.replay_path):
+            os.remove(self.replay_path)
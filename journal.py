@@ -0,0 +1,90 @@
+import sqlite3, json, threading, datetime as dt
+
+class Journal:
+    """
+    on-disk SQLite journal of an enrichment run. It records the state of every user (by User.get_id) as well as the
+    BigQuery insert status of every sub batch, so that an aborted run can be resumed without posting users to Orbit or
+    streaming them into BigQuery twice. Users move through the states 'posted' (the Orbit response is kept until it has
+    been ingested), 'done' and 'failed' (the user was recorded as dead letter).
+    """
+    def __init__(self, path = 'journal.db', run = 'default'):
+        self.path = path
+        self.run = run
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS users (run TEXT, id TEXT, status TEXT, response TEXT, PRIMARY KEY (run, id))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS batches (run TEXT, batch INTEGER, job TEXT, status TEXT, errors INTEGER, updated_at TEXT, PRIMARY KEY (run, batch, job))")
+
+    @property
+    def run(self):
+        return self.__run
+
+    @run.setter
+    def run(self, run):
+        if isinstance(run, str):
+            self.__run = run
+        else:
+            raise ValueError(f"'run' must be passed as String, not {type(run)}.")
+
+    def _select(self, ids, statuses):
+        ids = [x for x in ids if x != None]
+        if len(ids) == 0:
+            return []
+        query = (
+            "SELECT id, response FROM users WHERE run = ? AND id IN (" + ",".join("?" * len(ids)) + ")"
+            " AND status IN (" + ",".join("?" * len(statuses)) + ")"
+        )
+        with self.lock:
+            return self.connection.execute(query, [self.run, *ids, *statuses]).fetchall()
+
+    def finished(self, ids):
+        """
+        returns the set of ids that do not need to be processed again, i.e. that are either done or failed.
+        """
+        return {row[0] for row in self._select(ids, ['done', 'failed'])}
+
+    def posted(self, ids):
+        """
+        returns a dictionary with the Orbit responses of the ids that were posted to Orbit but not yet ingested into BigQuery.
+        """
+        return {row[0]: json.loads(row[1]) for row in self._select(ids, ['posted'])}
+
+    def _mark(self, rows):
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO users (run, id, status, response) VALUES (?, ?, ?, ?)", rows)
+
+    def mark_posted(self, responses):
+        """
+        records the Orbit responses passed as dictionary of id and response.
+        """
+        self._mark([(self.run, key, 'posted', json.dumps(value)) for key, value in responses.items() if key != None])
+
+    def mark_done(self, ids):
+        self._mark([(self.run, x, 'done', None) for x in ids if x != None])
+
+    def mark_failed(self, ids):
+        self._mark([(self.run, x, 'failed', None) for x in ids if x != None])
+
+    def mark_batch(self, batch, job, errors):
+        """
+        records the BigQuery insert status of a job for the sub batch with the given number.
+        """
+        status = 'ok' if errors == 0 else 'error'
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO batches (run, batch, job, status, errors, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.run, batch, job, status, errors, dt.datetime.now(dt.timezone.utc).isoformat())
+            )
+
+    def next_batch(self):
+        """
+        returns the number of the sub batch that follows the last recorded sub batch of the run.
+        """
+        with self.lock:
+            last = self.connection.execute("SELECT MAX(batch) FROM batches WHERE run = ?", (self.run,)).fetchone()[0]
+        return 0 if last == None else last + 1
+
+    def close(self):
+        self.connection.close()
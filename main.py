@@ -1,27 +1,159 @@
-import os, logging, datetime as dt
+import os, logging, argparse, datetime as dt
 from orbit import Orbit
 from data_clients import Accessor
 from async_manager import AsyncManager
+from dead_letter import DeadLetterStore
+from journal import Journal
+from cache import ResponseCache
+from change_index import ChangeIndex
+from watermark import Watermark
+from backfill import Backfill
+from sharding import ShardedManager
+from metrics import metrics
 
-def enrichment():
+def enrichment(shards = 1):
     """
     This method requests signup data from BigQuery and sends it to Orbit. In Orbit,
     the Signup data is enriched and the enriched data is then once again forwarded
     into BigQuery 
     """
     #query the data
+    lower_limit, upper_limit = dt.date(year=2021,month=6,day=28), dt.date(year=2021,month=6,day=30)
     bq_job = Accessor(query=os.environ.get('bq_query'))
-    bq_job.filter_time(lower_limit = dt.date(year=2021,month=6,day=28),upper_limit = dt.date(year=2021,month=6,day=30))
-    bq_job.execute()
-    logging.info(f"{len(bq_job.result)} users have been retrieved.")
+    bq_job.filter_time(lower_limit = lower_limit,upper_limit = upper_limit)
 
-    #create orbit instance
+    #with several shards, the users are enriched by worker processes which split the Orbit keys passed comma separated
+    if shards > 1:
+        sharded_manager = ShardedManager(
+            os.environ.get('orbit_key').split(','), "gitpod",
+            shards = shards,
+            run = f"{lower_limit}_{upper_limit}",
+            journal_path = 'journal.db',
+            cache_path = 'cache.db',
+            changes_path = 'changes.db',
+            dead_letter_path = 'dead_letter.jsonl',
+            log_file = 'debug.log'
+        )
+        count = sharded_manager.execute(bq_job.stream(mode = 'arrow'))
+        logging.info(f"{count} users have been processed in {shards} shards.")
+        return
+
+    #create orbit instance, users that cannot be inserted are recorded as dead letters
+    orbit = Orbit(os.environ.get('orbit_key'),"gitpod", dead_letter = DeadLetterStore())
+
+    #create asynchronous batch processor and execute the batch job while the users are streamed from BigQuery.
+    #the journal is keyed by the time window, so that a rerun of an aborted window resumes where it stopped
+    #the cache is shared by all runs, so that users occurring in overlapping windows are only posted once
+    #users that have not changed since their last enrichment are refreshed from the cache instead of being posted
+    journal = Journal(run = f"{lower_limit}_{upper_limit}")
+    cache = ResponseCache()
+    changes = ChangeIndex()
+    async_manager = AsyncManager(orbit, journal = journal, cache = cache, changes = changes)
+    count = async_manager.execute(bq_job.stream(mode = 'arrow'))
+    journal.close()
+    cache.close()
+    changes.close()
+    logging.info(f"{count} users have been processed.")
+
+def incremental():
+    """
+    This method enriches only the signups that were created after the high-water
+    mark of the last successful incremental run and advances the mark afterwards.
+    Without a mark, the signups of yesterday are enriched.
+    """
+    watermark = Watermark()
+    bq_job = Accessor(query=os.environ.get('bq_query'))
+    bq_job.filter_incremental(watermark.load())
+
+    orbit = Orbit(os.environ.get('orbit_key'),"gitpod", dead_letter = DeadLetterStore())
+    cache = ResponseCache()
+    changes = ChangeIndex()
+    async_manager = AsyncManager(orbit, cache = cache, changes = changes)
+    count = async_manager.execute(bq_job.stream(mode = 'arrow'))
+    cache.close()
+    changes.close()
+
+    #the mark is only advanced once the run has completed and all of its rows have been written to BigQuery
+    if async_manager.errors > 0:
+        logging.error(f"{async_manager.errors} rows could not be written to BigQuery. High-water mark is kept at {watermark.load()}.")
+        return
+    if bq_job.high_water_mark != None:
+        watermark.save(*bq_job.high_water_mark)
+    logging.info(f"{count} users have been processed. High-water mark is {bq_job.high_water_mark}.")
+
+def backfill(lower_limit, upper_limit, granularity):
+    """
+    This method enriches the signups of [lower_limit, upper_limit) in daily or
+    hourly partitions, of which several are processed concurrently under the
+    rate limit of one Orbit instance.
+    """
+    orbit = Orbit(os.environ.get('orbit_key'),"gitpod", dead_letter = DeadLetterStore())
+    cache = ResponseCache()
+    changes = ChangeIndex()
+    job = Backfill(orbit, os.environ.get('bq_query'), granularity = granularity, journal_path = 'journal.db', manager_options = {'cache': cache, 'changes': changes})
+    counts = job.execute(lower_limit, upper_limit)
+    cache.close()
+    changes.close()
+    logging.info(f"{sum(counts.values())} users in {len(counts)} partitions have been processed.")
+
+def export():
+    """
+    This method exports all members of the Orbit workspace page by page into
+    BigQuery, e.g. to refresh orbit_level and reach of the whole user base
+    without posting each signup to Orbit again. The members are upserted, so
+    that existing rows are updated and keep their signup_date.
+    """
     orbit = Orbit(os.environ.get('orbit_key'),"gitpod")
+    async_manager = AsyncManager(orbit, write_options = {'mode': 'upsert'})
+    count = async_manager.export()
+    if async_manager.errors > 0:
+        logging.error(f"{async_manager.errors} rows could not be written to BigQuery.")
+    logging.info(f"{count} members have been exported.")
 
-    #create asynchronous batch processor and execute the batch job
+def replay():
+    """
+    This method sends the users recorded in the dead letter store to Orbit once
+    again. Users that fail again are recorded as new dead letters.
+    """
+    dead_letters = DeadLetterStore()
+    orbit = Orbit(os.environ.get('orbit_key'),"gitpod", dead_letter = dead_letters)
     async_manager = AsyncManager(orbit)
-    async_manager.execute(bq_job.result)
+    count = async_manager.execute(dead_letters.replay())
+    dead_letters.complete_replay()
+    logging.info(f"{count} dead letters have been replayed.")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', nargs = '?', default = 'enrichment', choices = ['enrichment', 'incremental', 'backfill', 'export', 'replay'])
+    parser.add_argument('--lower', type = dt.date.fromisoformat, help = 'first day of the backfill')
+    parser.add_argument('--upper', type = dt.date.fromisoformat, help = 'day after the last day of the backfill')
+    parser.add_argument('--granularity', default = 'day', choices = ['day', 'hour'])
+    parser.add_argument('--shards', type = int, default = 1, help = 'number of worker processes of the enrichment')
+    parser.add_argument('--metrics-file', help = 'file the metrics are written to in the Prometheus text format')
+    parser.add_argument('--summary-file', help = 'file a JSON summary of the run is written to')
+    parser.add_argument('--metrics-port', type = int, help = 'port the metrics are served on at /metrics while the run is in progress')
+    args = parser.parse_args()
     logging.basicConfig(filename = 'debug.log', level = logging.DEBUG)
-    enrichment()
+    if args.mode == 'backfill' and (args.lower == None or args.upper == None):
+        parser.error("backfill requires --lower and --upper.")
+
+    #metrics are only recorded if they are exported in any way
+    metrics.enabled = any(option != None for option in [args.metrics_file, args.summary_file, args.metrics_port])
+    if args.metrics_port != None:
+        metrics.serve(args.metrics_port)
+    try:
+        if args.mode == 'replay':
+            replay()
+        elif args.mode == 'export':
+            export()
+        elif args.mode == 'incremental':
+            incremental()
+        elif args.mode == 'backfill':
+            backfill(args.lower, args.upper, args.granularity)
+        else:
+            enrichment(args.shards)
+    finally:
+        if args.metrics_file != None:
+            metrics.write_prometheus(args.metrics_file)
+        if args.summary_file != None:
+            metrics.write_summary(args.summary_file)
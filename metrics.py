@@ -0,0 +1,189 @@
+import json, threading, time, logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Metrics:
+    """
+    registry of the counters, gauges and histograms of the enrichment pipeline. Metrics are identified by name and
+    labels passed as keywords. While the registry is disabled, every call returns immediately, so that instrumented code
+    runs at practically no overhead. The metrics can be exported in the Prometheus text format (to a file or an HTTP
+    endpoint) and as JSON run summary.
+    """
+    #upper bounds of the histogram buckets in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters, self.gauges, self.histograms = {}, {}, {}
+        self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value = 1, **labels):
+        """
+        increases a counter.
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name, value, **labels):
+        """
+        changes a gauge by value, e.g. to track the number of in-flight requests.
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        sets a gauge to value.
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """
+        records value (usually a duration in seconds) in a histogram.
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram == None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0, 'count': 0}
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        """
+        returns all metrics as JSON serializable dictionary, e.g. to send them from a worker process to a coordinator.
+        """
+        def entries(metrics):
+            return [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in metrics.items()]
+        with self.lock:
+            return {
+                'counters': entries(self.counters),
+                'gauges': entries(self.gauges),
+                'histograms': entries({key: dict(value, buckets = list(value['buckets'])) for key, value in self.histograms.items()})
+            }
+
+    def merge(self, snapshot):
+        """
+        adds the metrics of a snapshot (e.g. of another process) to this registry.
+        """
+        if not self.enabled:
+            return
+        for entry in snapshot['counters']:
+            self.inc(entry['name'], entry['value'], **entry['labels'])
+        for entry in snapshot['gauges']:
+            self.add(entry['name'], entry['value'], **entry['labels'])
+        with self.lock:
+            for entry in snapshot['histograms']:
+                key = self._key(entry['name'], entry['labels'])
+                histogram = self.histograms.setdefault(key, {'buckets': [0] * len(self.BUCKETS), 'sum': 0, 'count': 0})
+                histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], entry['value']['buckets'])]
+                histogram['sum'] += entry['value']['sum']
+                histogram['count'] += entry['value']['count']
+
+    def to_prometheus(self):
+        """
+        returns the metrics in the Prometheus text exposition format.
+        """
+        def labels_of(labels, **extra):
+            pairs = list(labels) + list(extra.items())
+            if len(pairs) == 0:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            for kind, metrics in [('counter', self.counters), ('gauge', self.gauges)]:
+                for name in sorted({name for name, _ in metrics}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (metric, labels), value in metrics.items():
+                        if metric == name:
+                            lines.append(f"{name}{labels_of(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in self.histograms.items():
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                        cumulative += count
+                        le = "+Inf" if bound == float('inf') else str(bound)
+                        lines.append(f"{name}_bucket{labels_of(labels, le = le)} {cumulative}")
+                    lines.append(f"{name}_sum{labels_of(labels)} {histogram['sum']}")
+                    lines.append(f"{name}_count{labels_of(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        returns a JSON serializable run summary with the duration of the run, all counters and gauges and the count, sum
+        and mean of every histogram.
+        """
+        snapshot = self.snapshot()
+        for entry in snapshot['histograms']:
+            histogram = entry.pop('value')
+            entry.update({
+                'count': histogram['count'],
+                'sum': histogram['sum'],
+                'mean': histogram['sum'] / histogram['count'] if histogram['count'] > 0 else None
+            })
+        snapshot['duration'] = time.time() - self.started
+        return snapshot
+
+    def write_prometheus(self, path):
+        """
+        writes the metrics to a file in the Prometheus text format, e.g. for the textfile collector of the node exporter.
+        """
+        with open(path, 'w') as outfile:
+            outfile.write(self.to_prometheus())
+
+    def write_summary(self, path):
+        with open(path, 'w') as outfile:
+            json.dump(self.summary(), outfile, indent = 2)
+
+    def serve(self, port):
+        """
+        exposes the metrics in the Prometheus text format on http://0.0.0.0:port/metrics in a daemon thread and returns
+        the server, which can be stopped with shutdown.
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.to_prometheus().encode('utf-8')
+                self.send_response(200 if self.path == '/metrics' else 404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.end_headers()
+                if self.path == '/metrics':
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        return server
+
+#registry used by all modules of the pipeline, disabled unless enabled explicitly
+metrics = Metrics()
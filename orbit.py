@@ -1,17 +1,103 @@
-import logging, requests, time, json, asyncio, aiohttp
+import logging, requests, time, json, asyncio, aiohttp, collections
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from rate_limiter import RateLimiter
+from retry import RetryPolicy
+from metrics import metrics
+from codec import JSONCodec
+from concurrency import ConcurrencyController
 
 class Orbit:
-    def __init__(self, key, workspace):
+    #attributes of an Orbit member that are stored in BigQuery and the names under which they are stored
+    DEFAULT_KEYS = [
+        "github",
+        "name",
+        "company",
+        "location",
+        "bio",
+        "birthday",
+        "love",
+        "orbit_level",
+        "activities_count",
+        "reach",
+        "github_followers",
+        "twitter_followers",
+        "twitter",
+        "linkedin",
+        "discourse",
+        "email",
+        "devto",
+    ]
+    DEFAULT_RENAME = {
+        "activities_count": "orbit_activities",
+        "reach": "orbit_reach",
+        "love": "orbit_love",
+    }
+
+    def __init__(self, key, workspace, **kwargs):
         self.headers = {
             "Authorization": "Bearer " + key,
             "Accept": "application/json",
             "Content-Type": "application/json"
         }
         self.workspace = workspace
-    
+        #all requests to the Orbit API are throttled by the limiter, which can be shared by several Orbit instances
+        self.limiter = kwargs.get('limiter', RateLimiter())
+        self.retry = kwargs.get('retry', RetryPolicy())
+        #users whose insertion failed for good are recorded in the dead letter store, if one is attached
+        self.dead_letter = kwargs.get('dead_letter', None)
+        #the base url can be pointed to a stand-in of the Orbit API, e.g. the fake server of the benchmark
+        self.base_url = kwargs.get('base_url', "https://app.orbit.love/api/v1/")
+        self.endpoint = self.base_url+self.workspace+"/members"
+        #members are encoded and responses decoded by the codec, which only keeps the attributes that are persisted. Pass
+        #a codec with other keys if the ResponseTransformer extracts other attributes
+        self.codec = kwargs.get('codec', JSONCodec(keys = self.DEFAULT_KEYS + ["languages"]))
+
+        #synchronous calls share a pool of keep-alive connections
+        self.pool_size = kwargs.get('pool_size', 10)
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        for prefix in ["https://", "http://"]:
+            self.session.mount(prefix, HTTPAdapter(pool_connections = 1, pool_maxsize = self.pool_size))
+
+        #asynchronous calls share one aiohttp session, which is opened on the running event loop by open_session
+        self.connections = kwargs.get('connections', 100)
+        #the number of in-flight asynchronous requests adapts to the latency and errors of Orbit, separately from the rate
+        self.concurrency = kwargs.get('concurrency', ConcurrencyController(maximum = self.connections))
+        self.async_session = None
+        self.async_session_users = 0
+
+    async def open_session(self):
+        """
+        returns the aiohttp session shared by the asynchronous calls and creates it with a tuned connector if it is not
+        open yet. The headers and the timeout are set once on the session instead of on every request, so the asynchronous
+        calls require a session returned by this method. The session is bound to the running event loop and has to be
+        closed with close_session by every caller, it is only closed once the last caller has closed it.
+        """
+        if self.async_session == None or self.async_session.closed:
+            connector = aiohttp.TCPConnector(limit = self.connections, limit_per_host = self.connections, ttl_dns_cache = 300, keepalive_timeout = 60)
+            timeout = aiohttp.ClientTimeout(total = self.retry.timeout)
+            self.async_session = aiohttp.ClientSession(connector = connector, headers = self.headers, timeout = timeout)
+            self.async_session_users = 0
+        self.async_session_users += 1
+        return self.async_session
+
+    async def close_session(self):
+        self.async_session_users -= 1
+        if self.async_session != None and self.async_session_users <= 0:
+            await self.async_session.close()
+            self.async_session = None
+
+    def close(self):
+        """
+        closes the pooled connections of the synchronous calls.
+        """
+        self.session.close()
+
     def user_parse(self, user):
         """
-        returns a JSON representation of the user that can be passed to the orbit API.
+        returns the JSON encoded user (as bytes) that can be passed to the orbit API.
         """
         member ={}
         if user.github != None:
@@ -20,7 +106,7 @@ class Orbit:
             member['email'] = user.email
         if user.name != None:
             member['name'] = user.name
-        return json.dumps({"member": member})
+        return self.codec.encode({"member": member})
 
     def add_member(self, user):
         """
@@ -29,18 +115,33 @@ class Orbit:
                  
         data = self.user_parse(user)
         logging.debug(f"Successfully parsed User {str(user)}. Making Orbit request now...")
-        endpoint  = "https://app.orbit.love/api/v1/"+self.workspace+"/members"
-        response = requests.post(endpoint, data = data, headers = self.headers)
-        if response.ok:
-            out = response.json()
-            logging.debug(f"Successfully inserted user {str(user)} in Orbit.")
-            return {
-                "bigquery":user.to_dict(),
-                "orbit": out
-            }
-        else:
-            logging.debug(f"Sent User {str(user)} to orbit and Error occurred:\n{str(response)}")
-            return {}
+        for attempt in range(self.retry.retries + 1):
+            self.limiter.wait()
+            started = time.perf_counter()
+            try:
+                response = self.session.post(self.endpoint, data = data, timeout = self.retry.timeout)
+            except requests.RequestException as e:
+                status, error = None, repr(e)
+                metrics.observe('orbit_request_seconds', time.perf_counter() - started, status = status)
+            else:
+                metrics.observe('orbit_request_seconds', time.perf_counter() - started, status = response.status_code)
+                self.limiter.update(response.status_code, response.headers)
+                if response.ok:
+                    out = self.codec.decode_member(response.content)
+                    logging.debug(f"Successfully inserted user {str(user)} in Orbit.")
+                    return {
+                        "bigquery":user.to_dict(),
+                        "orbit": out
+                    }
+                status, error = response.status_code, response.text
+            if attempt == self.retry.retries or not self.retry.is_retryable(status):
+                break
+            delay = self.retry.delay(attempt)
+            logging.debug(f"Orbit request for User {str(user)} returned with status {status}. Retrying in {delay:.1f} second(s)...")
+            metrics.inc('orbit_retries_total', status = status)
+            time.sleep(delay)
+        self.dead_letter_user(user, status, error)
+        return {}
     
     async def async_add_member(self, session, user):
         """
@@ -48,56 +149,180 @@ class Orbit:
         """  
         data = self.user_parse(user)
         logging.debug(f"Successfully parsed User {str(user)}. Making Orbit request now...")
-        endpoint  = "https://app.orbit.love/api/v1/"+self.workspace+"/members"
-        async with session.post(endpoint, data = data, headers = self.headers) as resp:        
-            if 200 <= resp.status <= 201:
-                response = await resp.json()
-                logging.debug(f"Successfully inserted user {str(user)} in Orbit.")
-                return {
-                    "bigquery":user.to_dict(),
-                    "orbit": response
-                }
-            else:
-                response = await resp.text()
-                logging.debug(f"Orbit request for User {str(user)} returned with status {resp.status}. Refer to return body below:\n{response}")
+        status, body, error = await self._request(session, 'POST', f"User {str(user)}", data = data)
+        if body != None:
+            logging.debug(f"Successfully inserted user {str(user)} in Orbit.")
+            return {
+                "bigquery":user.to_dict(),
+                "orbit": self.codec.decode_member(body)
+            }
+        self.dead_letter_user(user, status, error)
+
+    async def _request(self, session, method, label, path = "", **kwargs):
+        """
+        sends a request to the members endpoint (followed by path, e.g. "/" and the id of a member), throttled by the rate
+        limiter and the concurrency controller, and retries it according to the retry policy. Returns the status, the body
+        of a successful response (None otherwise) and the error of the last attempt. The request is referred to as label in
+        the logs, the keywords are passed to aiohttp.
+        """
+        for attempt in range(self.retry.retries + 1):
+            await self.concurrency.acquire()
+            status, started = None, None
+            try:
+                await self.limiter.acquire()
+                started = time.perf_counter()
+                metrics.add('orbit_requests_in_flight', 1)
+                async with session.request(method, self.endpoint+path, **kwargs) as resp:
+                    status = resp.status
+                    self.limiter.update(resp.status, resp.headers)
+                    if resp.ok:
+                        return status, await resp.read(), None
+                    error = await resp.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, error = None, repr(e)
+            finally:
+                latency = time.perf_counter() - started if started != None else None
+                self.concurrency.release(status, latency)
+                if started != None:
+                    metrics.add('orbit_requests_in_flight', -1)
+                    metrics.observe('orbit_request_seconds', latency, status = status)
+            if attempt == self.retry.retries or not self.retry.is_retryable(status):
+                break
+            delay = self.retry.delay(attempt)
+            logging.debug(f"Orbit request for {label} returned with status {status}. Retrying in {delay:.1f} second(s)...")
+            metrics.inc('orbit_retries_total', status = status)
+            await asyncio.sleep(delay)
+        return status, None, error
+
+    def dead_letter_user(self, user, status, error):
+        """
+        logs a user whose insertion failed for good and records it in the dead letter store.
+        """
+        logging.warning(f"Orbit request for User {str(user)} failed with status {status}. Refer to return body below:\n{error}")
+        metrics.inc('orbit_failures_total', status = status)
+        if self.dead_letter != None:
+            self.dead_letter.add(user, status, error)
 
     def get_member(self, user_id):
         """
         retrieve the member with the provided user_id from the current Orbit Workspace.
         """
-        endpoint =  "https://app.orbit.love/api/v1/"+self.workspace+"/members/"+user_id
-        response = requests.get(endpoint, headers = self.headers)
+        self.limiter.wait()
+        response = self.session.get(self.endpoint+"/"+user_id)
+        self.limiter.update(response.status_code, response.headers)
         if response.ok:
             return response.json()
         else:
             return {}
 
+    async def async_get_member(self, session, user_id):
+        """
+        retrieve the member with the provided user_id from the current Orbit Workspace in an asynchronous request.
+        """
+        status, body, error = await self._request(session, 'GET', f"member {user_id}", path = "/"+user_id)
+        if body != None:
+            return self.codec.decode(body)
+        else:
+            return {}
+
+    async def async_list_members(self, session, page, **kwargs):
+        """
+        retrieves a page of the members list of the current Orbit Workspace in an asynchronous request and returns the
+        response body, or None if the request failed for good. The number of members per page can be set in the 'items'
+        keyword.
+        """
+        params = {'page': page, 'items': kwargs.get('items', 100)}
+        status, body, error = await self._request(session, 'GET', f"page {page} of the members", params = params)
+        if body != None:
+            return self.codec.decode(body)
+        logging.error(f"Orbit request for page {page} of the members failed with status {status}. Refer to return body below:\n{error}")
+        metrics.inc('orbit_failures_total', status = status)
+        return None
+
+    async def export_members(self, session, **kwargs):
+        """
+        walks the paginated members list of the current Orbit Workspace and yields the members page by page and in order.
+        Up to 'prefetch' pages are requested concurrently, all of them throttled by the rate limiter. The number of members
+        per page can be set in the 'items' keyword (Orbit allows at most 100). Pages that fail for good are logged and
+        skipped once the number of pages is known. A RuntimeError is raised if a page fails before, as the end of the list
+        cannot be told then, or if 'max_failed_pages' pages fail in a row.
+        """
+        items = kwargs.get('items', 100)
+        prefetch = kwargs.get('prefetch', 4)
+        max_failed_pages = kwargs.get('max_failed_pages', 3)
+        #the number of pages is taken from the link to the last page once known, otherwise a short page ends the export
+        tasks, page, last, failed = collections.deque(), 0, None, 0
+        try:
+            while True:
+                while len(tasks) < prefetch and (last == None or page < last):
+                    page += 1
+                    tasks.append(asyncio.ensure_future(self.async_list_members(session, page, items = items)))
+                if len(tasks) == 0:
+                    break
+                body = await tasks.popleft()
+                if body == None:
+                    failed += 1
+                    if last == None:
+                        raise RuntimeError("A page of the members failed before the number of pages was known.")
+                    if failed >= max_failed_pages:
+                        raise RuntimeError(f"{failed} pages of the members failed in a row.")
+                    continue
+                failed = 0
+                last = self._last_page(body, last)
+                members = body.get('data', [])
+                if len(members) > 0:
+                    yield members
+                if len(members) < items:
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def _last_page(body, default = None):
+        """
+        returns the number of the last page from the links of a members list response.
+        """
+        link = (body.get('links') or {}).get('last')
+        try:
+            return int(parse_qs(urlparse(link).query)['page'][0])
+        except (TypeError, KeyError, IndexError, ValueError):
+            return default
+
     def delete_member(self, user_id):
         """
         delete the member with the provided user_id from the current Orbit Workspace.
         """
-        endpoint =  "https://app.orbit.love/api/v1/"+self.workspace+"/members/"+user_id
-        response = requests.delete(endpoint, headers = self.headers)
-        if response.ok:
+        self.limiter.wait()
+        response = self.session.delete(self.endpoint+"/"+user_id)
+        self.limiter.update(response.status_code, response.headers)
+        #successful deletions may come without content
+        if response.ok and len(response.content) > 0:
             return response.json()
         else:
             return {}
+
+    async def async_delete_member(self, session, user_id):
+        """
+        delete the member with the provided user_id from the current Orbit Workspace in an asynchronous request.
+        """
+        status, body, error = await self._request(session, 'DELETE', f"member {user_id}", path = "/"+user_id)
+        #successful deletions may come without content
+        if body != None and len(body) > 0:
+            return self.codec.decode(body)
+        else:
+            return {}
     
     def batch_job(self, function, batch, **kwargs):
         """
-        executes a any orbit function for each element passed in batch. in keywords a
-        limit for consecutive calls before a setting a timeout can be specified.
-        """
-        rate_limit = kwargs.get('limit', 100)
-        timeout = kwargs.get('timeout', 0)
-        count = 0
-        response = []
-        for item in batch:
-            response.append(function(item))
-            count += 1
-            if count % rate_limit == 0:
-                print(f"{count} calls have been processed. Timing out for {timeout} minute(s) in order to stay under the rate limit")
-                time.sleep(timeout)
+        executes a any orbit function for each element passed in batch and returns the responses in the order of batch.
+        The calls are made by a pool of threads whose size can be set in the 'workers' keyword and are throttled by the
+        rate limiter.
+        """
+        workers = kwargs.get('workers', self.pool_size)
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            response = list(executor.map(function, batch))
+        logging.info(f"{len(response)} calls have been processed.")
         return response
 
     @staticmethod
@@ -110,32 +335,8 @@ class Orbit:
         if 'orbit' not in response or 'data' not in response['orbit']:
             return None, None
         data = response['orbit']['data']['attributes']
-        default_keys = [
-            "github",
-            "name",
-            "company",
-            "location",
-            "bio",
-            "birthday",
-            "love",
-            "orbit_level",
-            "activities_count",
-            "reach",
-            "github_followers",
-            "twitter_followers",
-            "twitter",
-            "linkedin",
-            "discourse",
-            "email",
-            "devto",
-        ]
-        keys = kwargs.get('keys',default_keys)
-        default_rename = {
-            "activities_count": "orbit_activities",
-            "reach": "orbit_reach",
-            "love": "orbit_love",
-        }
-        rename = kwargs.get('rename', default_rename)
+        keys = kwargs.get('keys', Orbit.DEFAULT_KEYS)
+        rename = kwargs.get('rename', Orbit.DEFAULT_RENAME)
 
         #only store data specified in keys in user_response
         user_response = {key: data[key] for key in keys}
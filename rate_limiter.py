@@ -0,0 +1,175 @@
+import asyncio, time, threading, logging, datetime as dt
+from email.utils import parsedate_to_datetime
+from metrics import metrics
+
+class RateLimiter:
+    """
+    token bucket that is shared by every call made to the Orbit API. Tokens refill continuously at 'limit' tokens per
+    'period' seconds up to 'burst' tokens. The bucket calibrates itself from the rate limit headers of each response and
+    backs off on 429 responses, honouring the 'Retry-After' header if present. If the quota of a key is shared by several
+    buckets, 'share' is the fraction of the limit sent in the headers that this bucket may use.
+    """
+    def __init__(self, **kwargs):
+        self.limit = kwargs.get('limit', 120)
+        self.share = kwargs.get('share', 1)
+        self.period = kwargs.get('period', 60)
+        self.burst = kwargs.get('burst', 1)
+        self.backoff_factor = kwargs.get('backoff_factor', 0.5)
+        self.recovery = kwargs.get('recovery', 0.05)
+        self.limit_header = kwargs.get('limit_header', 'X-RateLimit-Limit')
+        self.remaining_header = kwargs.get('remaining_header', 'X-RateLimit-Remaining')
+        self.reset_header = kwargs.get('reset_header', 'X-RateLimit-Reset')
+        self.rate = self.nominal_rate
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        #incremented on every backoff so that reservations made before a 429 are renewed
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return self.__limit
+
+    @limit.setter
+    def limit(self, limit):
+        if isinstance(limit, (int, float)) and limit > 0:
+            self.__limit = limit
+        else:
+            raise ValueError(f"'limit' must be a positive number, not {limit}.")
+
+    @property
+    def share(self):
+        return self.__share
+
+    @share.setter
+    def share(self, share):
+        if isinstance(share, (int, float)) and 0 < share <= 1:
+            self.__share = share
+        else:
+            raise ValueError(f"'share' must be a number between 0 and 1, not {share}.")
+
+    @property
+    def period(self):
+        return self.__period
+
+    @period.setter
+    def period(self, period):
+        if isinstance(period, (int, float)) and period > 0:
+            self.__period = period
+        else:
+            raise ValueError(f"'period' must be a positive number, not {period}.")
+
+    @property
+    def nominal_rate(self):
+        """
+        returns the number of tokens refilled per second according to the quota.
+        """
+        return self.limit / self.period
+
+    def _refill(self, now):
+        #'updated' lies in the future while the bucket is paused, which yields a negative balance until the pause is over
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """
+        takes one token from the bucket and returns the generation of the bucket as well as the number of seconds the
+        caller has to wait before the token may be spent.
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return self.generation, wait
+
+    async def acquire(self):
+        """
+        waits asynchronously until a token is available.
+        """
+        while True:
+            generation, wait = self.reserve()
+            if wait > 0:
+                metrics.inc('rate_limit_sleep_seconds_total', wait)
+                await asyncio.sleep(wait)
+            if generation == self.generation:
+                return
+
+    def wait(self):
+        """
+        blocks the current thread until a token is available.
+        """
+        while True:
+            generation, wait = self.reserve()
+            if wait > 0:
+                metrics.inc('rate_limit_sleep_seconds_total', wait)
+                time.sleep(wait)
+            if generation == self.generation:
+                return
+
+    def backoff(self, retry_after=None):
+        """
+        empties the bucket, pauses it for 'retry_after' seconds (a full period if None) and reduces the refill rate.
+        """
+        pause = self.period if retry_after is None else retry_after
+        with self.lock:
+            self.rate = max(self.rate * self.backoff_factor, self.nominal_rate / self.limit)
+            self.tokens = 0
+            self.updated = max(self.updated, time.monotonic() + pause)
+            self.generation += 1
+        metrics.inc('rate_limit_backoffs_total')
+        logging.info(f"Orbit rate limit was hit. Pausing requests for {pause:.1f} second(s) and reducing rate to {self.rate * 60:.1f} requests per minute.")
+
+    def update(self, status, headers):
+        """
+        calibrates the bucket from the status and headers of an Orbit response.
+        """
+        limit = self._parse_number(headers.get(self.limit_header))
+        if limit:
+            #the headers report the quota of the whole key
+            self.limit = limit * self.share
+        if status == 429:
+            self.backoff(self._parse_retry_after(headers.get('Retry-After')))
+            return
+        remaining = self._parse_number(headers.get(self.remaining_header))
+        with self.lock:
+            now = time.monotonic()
+            self.rate = min(self.nominal_rate, self.rate + self.nominal_rate * self.recovery)
+            if remaining is None:
+                return
+            self._refill(now)
+            #never hold more tokens than Orbit still grants in the current window
+            self.tokens = min(self.tokens, remaining)
+            if remaining <= 0:
+                reset = self._parse_reset(headers.get(self.reset_header))
+                self.updated = max(self.updated, now + (self.period if reset is None else reset))
+
+    @staticmethod
+    def _parse_number(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def _parse_retry_after(cls, value):
+        """
+        parses a 'Retry-After' header, which is either given in seconds or as HTTP date.
+        """
+        seconds = cls._parse_number(value)
+        if seconds is not None or value is None:
+            return seconds
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0, (date - dt.datetime.now(dt.timezone.utc)).total_seconds())
+
+    @classmethod
+    def _parse_reset(cls, value):
+        """
+        parses a reset header, which is either given in seconds until reset or as epoch timestamp.
+        """
+        reset = cls._parse_number(value)
+        if reset is not None and reset > 1e9:
+            reset = max(0, reset - time.time())
+        return reset
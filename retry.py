@@ -0,0 +1,38 @@
+import random
+
+class RetryPolicy:
+    """
+    describes how often and after which delay a failed Orbit request is retried. Requests that time out, fail on the
+    connection or return a status listed in 'retryable' (or any 5xx status) are retried up to 'retries' times with full
+    jitter exponential backoff. All other statuses are permanent and fail immediately.
+    """
+    def __init__(self, **kwargs):
+        self.retries = kwargs.get('retries', 3)
+        self.base = kwargs.get('base', 1)
+        self.cap = kwargs.get('cap', 60)
+        self.timeout = kwargs.get('timeout', 30)
+        self.retryable = set(kwargs.get('retryable', [408, 425, 429]))
+
+    @property
+    def retries(self):
+        return self.__retries
+
+    @retries.setter
+    def retries(self, retries):
+        if isinstance(retries, int) and retries >= 0:
+            self.__retries = retries
+        else:
+            raise ValueError(f"'retries' must be a non-negative Integer, not {retries}.")
+
+    def is_retryable(self, status):
+        """
+        returns whether a request that failed with status should be retried. A status of None stands for a request that
+        did not receive a response (timeout or connection error).
+        """
+        return status is None or status >= 500 or status in self.retryable
+
+    def delay(self, attempt):
+        """
+        returns the number of seconds to wait before the retry following the given attempt (starting at 0).
+        """
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
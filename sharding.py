@@ -0,0 +1,187 @@
+import os, logging, zlib, queue, multiprocessing as mp
+from orbit import Orbit
+from rate_limiter import RateLimiter
+from async_manager import AsyncManager
+from dead_letter import DeadLetterStore
+from journal import Journal
+from cache import ResponseCache
+from change_index import ChangeIndex
+from metrics import metrics
+
+def shard_of(user, shards):
+    """
+    returns the shard of a user, which is derived from a stable hash of User.get_id, so that a user is always processed by
+    the same shard.
+    """
+    key = user.get_id()
+    return zlib.crc32(key.encode('utf-8')) % shards if key != None else 0
+
+def _receive(inbox):
+    """
+    yields the users of the chunks sent to a worker until the coordinator sends None.
+    """
+    for chunk in iter(inbox.get, None):
+        yield from chunk
+
+def _work(shard, key, workspace, limit, share, inbox, outbox, options):
+    """
+    entry point of a worker process. It enriches the users sent to its inbox with its own Orbit instance, rate limiter and
+    session and sends a summary of its run, including a snapshot of its metrics, to the outbox.
+    """
+    metrics.enabled = options.get('metrics', False)
+    if options.get('log_file') != None:
+        logging.basicConfig(filename = options['log_file'], level = options.get('log_level', logging.INFO), format = f"shard {shard}: %(levelname)s %(message)s")
+    try:
+        dead_letter = DeadLetterStore(options['dead_letter_path'] + f".shard{shard}") if options.get('dead_letter_path') != None else None
+        limiter = RateLimiter(limit = limit, share = share, period = options.get('period', 60))
+        orbit_options = {'base_url': options['base_url']} if options.get('base_url') != None else {}
+        orbit = Orbit(key, workspace, limiter = limiter, dead_letter = dead_letter, **orbit_options)
+        #every shard journals its own run, so that the shards do not overwrite the batch numbers of each other
+        journal = Journal(options['journal_path'], run = f"{options.get('run', 'default')}_shard{shard}") if options.get('journal_path') != None else None
+        cache = ResponseCache(options['cache_path']) if options.get('cache_path') != None else None
+        changes = ChangeIndex(options['changes_path']) if options.get('changes_path') != None else None
+        manager = AsyncManager(orbit, journal = journal, cache = cache, changes = changes, write_options = options.get('write_options', {}))
+        count = manager.execute(_receive(inbox), **options.get('batch_options', {}))
+        for store in [journal, cache, changes]:
+            if store != None:
+                store.close()
+        orbit.close()
+        outbox.put({'shard': shard, 'users': count, 'error': None, 'metrics': metrics.snapshot()})
+    except Exception as e:
+        logging.exception(f"Shard {shard} failed.")
+        outbox.put({'shard': shard, 'users': 0, 'error': repr(e), 'metrics': metrics.snapshot()})
+
+class ShardedManager:
+    """
+    runs the enrichment in several worker processes, so that encoding, decoding and parsing are spread across cores. Users
+    are partitioned by a hash of User.get_id across 'shards' workers (one per Orbit key by default). Keys are assigned to
+    the shards round robin and the rate 'limit' per 'period' of a key is split evenly between the shards that use it,
+    also when the limit is calibrated from the rate limit headers of Orbit.
+    Journal, cache, change index and dead letter store are configured by path ('journal_path', 'cache_path',
+    'changes_path', 'dead_letter_path'), as every worker opens its own. Journal, cache and change index are shared SQLite
+    files, in which each shard journals the run 'run' suffixed with its shard number, while the dead letters of each shard are merged
+    into the dead letter store by the coordinator once all shards have completed.
+    """
+    def __init__(self, keys, workspace, **kwargs):
+        self.keys = keys if isinstance(keys, list) else [keys]
+        self.workspace = workspace
+        self.shards = kwargs.get('shards', len(self.keys))
+        self.limit = kwargs.get('limit', 120)
+        self.chunk_size = kwargs.get('chunk_size', 100)
+        self.queue_size = kwargs.get('queue_size', 8)
+        self.options = {
+            'period': kwargs.get('period', 60),
+            'base_url': kwargs.get('base_url', None),
+            'journal_path': kwargs.get('journal_path', None),
+            'run': kwargs.get('run', 'default'),
+            'cache_path': kwargs.get('cache_path', None),
+            'changes_path': kwargs.get('changes_path', None),
+            'dead_letter_path': kwargs.get('dead_letter_path', None),
+            'write_options': kwargs.get('write_options', {}),
+            'batch_options': kwargs.get('batch_options', {}),
+            'log_file': kwargs.get('log_file', None),
+            'log_level': kwargs.get('log_level', logging.INFO),
+            #workers record metrics if the registry of the coordinator is enabled when the manager is created
+            'metrics': metrics.enabled
+        }
+        self.summary = []
+
+    def share_of(self, shard):
+        """
+        returns the fraction of the rate limit of its key that the shard may use. The rate limiter of the shard applies it
+        to the limit reported by Orbit as well.
+        """
+        sharing = len(range(shard % len(self.keys), self.shards, len(self.keys)))
+        return 1 / sharing
+
+    def limit_of(self, shard):
+        """
+        returns the share of the rate limit of the key used by the shard.
+        """
+        return self.limit * self.share_of(shard)
+
+    def merge_dead_letters(self):
+        """
+        appends the dead letters of all shards to the dead letter store and removes the files of the shards.
+        """
+        path = self.options['dead_letter_path']
+        if path == None:
+            return
+        with open(path, 'a') as outfile:
+            for shard in range(self.shards):
+                shard_path = path + f".shard{shard}"
+                if os.path.exists(shard_path):
+                    with open(shard_path) as infile:
+                        outfile.write(infile.read())
+                    os.remove(shard_path)
+
+    def execute(self, batch):
+        """
+        distributes the users of batch (any iterable of users) across the worker processes and returns the total number of
+        processed users. The summary of each shard is kept in summary.
+        """
+        #workers are spawned instead of forked, as forking a process with open gRPC or HTTP connections is unsafe
+        context = mp.get_context('spawn')
+        outbox = context.Queue()
+        inboxes = [context.Queue(maxsize = self.queue_size) for _ in range(self.shards)]
+        workers = [
+            context.Process(
+                target = _work,
+                args = (shard, self.keys[shard % len(self.keys)], self.workspace, self.limit_of(shard), self.share_of(shard), inboxes[shard], outbox, self.options),
+                daemon = True
+            )
+            for shard in range(self.shards)
+        ]
+        for worker in workers:
+            worker.start()
+
+        def send(shard, item):
+            #bounded inboxes apply backpressure, a dead worker would block the coordinator forever though
+            while True:
+                try:
+                    inboxes[shard].put(item, timeout = 1)
+                    return
+                except queue.Full:
+                    if not workers[shard].is_alive():
+                        raise RuntimeError(f"Shard {shard} has terminated unexpectedly.")
+
+        try:
+            chunks = [[] for _ in range(self.shards)]
+            for user in batch:
+                shard = shard_of(user, self.shards)
+                chunks[shard].append(user)
+                if len(chunks[shard]) >= self.chunk_size:
+                    send(shard, chunks[shard])
+                    chunks[shard] = []
+            for shard, chunk in enumerate(chunks):
+                if len(chunk) > 0:
+                    send(shard, chunk)
+        finally:
+            for shard in range(self.shards):
+                if workers[shard].is_alive():
+                    send(shard, None)
+
+        #the summaries have to be received before the workers are joined, shards that died without one count as failed
+        summaries = {}
+        while len(summaries) < self.shards:
+            try:
+                summary = outbox.get(timeout = 1)
+                summaries[summary['shard']] = summary
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers) and outbox.empty():
+                    break
+        for worker in workers:
+            worker.join()
+        self.summary = [summaries.get(shard, {'shard': shard, 'users': 0, 'error': 'terminated without summary'}) for shard in range(self.shards)]
+        #the metrics of the workers are added to the registry of the coordinator
+        for summary in self.summary:
+            if summary.get('metrics') != None:
+                metrics.merge(summary['metrics'])
+        self.merge_dead_letters()
+
+        errors = [summary for summary in self.summary if summary['error'] != None]
+        for summary in errors:
+            logging.error(f"Shard {summary['shard']} failed: {summary['error']}")
+        if len(errors) > 0:
+            raise RuntimeError(f"{len(errors)} of {self.shards} shards failed.")
+        return sum(summary['users'] for summary in self.summary)
@@ -1,6 +1,22 @@
-import unittest, os, warnings
+import unittest, os, warnings, tempfile, asyncio, datetime as dt
 from user import User
 from orbit import Orbit
+from rate_limiter import RateLimiter
+from retry import RetryPolicy
+from journal import Journal
+from dead_letter import DeadLetterStore
+from cache import ResponseCache
+from change_index import ChangeIndex
+from async_manager import AsyncManager
+from data_clients import Accessor, Integrator
+from transform import ResponseTransformer
+from watermark import Watermark
+from backfill import Backfill
+from sharding import ShardedManager, shard_of
+from metrics import Metrics
+from codec import JSONCodec, msgspec, orjson
+from concurrency import ConcurrencyController
+from benchmark import FakeOrbit, FakeBigQuery, benchmark_async_manager, benchmark_batch_job
 
 class TestUser(unittest.TestCase):
     def test_valid_user(self):
@@ -22,6 +38,490 @@ class TestUser(unittest.TestCase):
         invalid_name_user = User(name = name)
         self.assertIsNone(invalid_name_user.name)
 
+    def test_from_rows(self):
+        rows = [
+            {'email': 'jakob@gitpod.io', 'name': 'jakob', 'github': 'github', 'created_at': None},
+            {'email': '123.de', 'name': 123, 'github': 'github2', 'created_at': None}
+        ]
+        with warnings.catch_warnings(record = True) as caught:
+            warnings.simplefilter('always')
+            users = User.from_rows(rows)
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(users[0].email, 'jakob@gitpod.io')
+        self.assertIsNone(users[1].email)
+        self.assertIsNone(users[1].name)
+        self.assertEqual(users[1].github, 'github2')
+
+class TestRateLimiter(unittest.TestCase):
+    def test_refill(self):
+        limiter = RateLimiter(limit = 60, period = 60)
+        _, first = limiter.reserve()
+        _, second = limiter.reserve()
+        self.assertEqual(first, 0)
+        self.assertAlmostEqual(second, 1, places = 2)
+
+    def test_retry_after(self):
+        limiter = RateLimiter(limit = 60, period = 60)
+        limiter.update(429, {'Retry-After': '10'})
+        _, wait = limiter.reserve()
+        self.assertGreater(wait, 10)
+        self.assertLess(limiter.rate, limiter.nominal_rate)
+
+    def test_calibration(self):
+        limiter = RateLimiter(limit = 60, period = 60, burst = 10)
+        limiter.update(200, {'X-RateLimit-Limit': '120', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '5'})
+        self.assertEqual(limiter.nominal_rate, 2)
+        _, wait = limiter.reserve()
+        self.assertGreater(wait, 5)
+
+    def test_share(self):
+        limiter = RateLimiter(limit = 60, period = 60, share = 0.5)
+        limiter.update(200, {'X-RateLimit-Limit': '120'})
+        self.assertEqual(limiter.limit, 60)
+        with self.assertRaises(ValueError):
+            RateLimiter(share = 2)
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_statuses(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.is_retryable(None))
+        self.assertTrue(policy.is_retryable(429))
+        self.assertTrue(policy.is_retryable(503))
+        self.assertFalse(policy.is_retryable(422))
+
+    def test_delay(self):
+        policy = RetryPolicy(base = 1, cap = 5)
+        for attempt in range(10):
+            self.assertLessEqual(policy.delay(attempt), min(5, 2 ** attempt))
+
+class TestDeadLetterStore(unittest.TestCase):
+    def test_replay(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = DeadLetterStore(os.path.join(directory, 'dead_letter.jsonl'))
+            store.add(User(github = "jakob1", email = "test1@test.org"), 500, "internal server error")
+            store.add(User(github = "jakob2"), None, "timeout")
+            self.assertEqual([user.github for user in store.replay()], ["jakob1", "jakob2"])
+            #the letters are kept until the replay is completed, failures of the replay go to a fresh store
+            self.assertFalse(os.path.exists(store.path))
+            self.assertTrue(os.path.exists(store.replay_path))
+            store.complete_replay()
+            self.assertEqual(list(store.replay()), [])
+
+    def test_retry_and_replay(self):
+        with tempfile.TemporaryDirectory() as directory, FakeOrbit(latency = 0) as server:
+            store = DeadLetterStore(os.path.join(directory, 'dead_letter.jsonl'))
+            orbit = Orbit(
+                "key", "gitpod", base_url = server.url, dead_letter = store,
+                limiter = RateLimiter(limit = 1000, period = 1), retry = RetryPolicy(retries = 2, base = 0.001)
+            )
+            manager = AsyncManager(orbit, write_options = {'client': FakeBigQuery()})
+            manager.execute([User(github = "jakob1"), User(github = "jakob2")])
+            #a 500 is retried twice and the user is dead lettered once the retries are exhausted
+            server.error_rate = 1
+            manager.execute([User(github = "jakob3")])
+            self.assertEqual(server.requests, 2 + 3)
+            with open(store.path) as infile:
+                self.assertEqual(len(infile.readlines()), 1)
+
+            #the replay only sends the failed user again
+            server.error_rate, server.requests = 0, 0
+            users = list(store.replay())
+            self.assertEqual([user.github for user in users], ["jakob3"])
+            manager.execute(users)
+            store.complete_replay()
+            self.assertEqual(server.requests, 1)
+            self.assertFalse(os.path.exists(store.path))
+            orbit.close()
+
+class TestConcurrencyController(unittest.TestCase):
+    def test_aimd(self):
+        controller = ConcurrencyController(initial = 4, maximum = 8)
+        #until the first congestion the limit grows by one per request
+        controller.in_flight += 1
+        controller.release(201, 0.1)
+        self.assertEqual(controller.limit, 5)
+        controller.in_flight += 1
+        controller.release(None, 0.1)
+        self.assertEqual(controller.limit, 2.5)
+        #after the first congestion the limit grows by one per round
+        controller.in_flight += 1
+        controller.release(201, 0.1)
+        self.assertEqual(controller.limit, 2.9)
+        #a recent latency above twice the baseline counts as congestion, but only once per round trip
+        controller.decreased = 0
+        for _ in range(10):
+            controller.in_flight += 1
+            controller.release(201, 1)
+        self.assertEqual(controller.limit, 1.45)
+
+    def test_acquire(self):
+        async def run():
+            controller = ConcurrencyController(initial = 2)
+            await controller.acquire()
+            await controller.acquire()
+            waiter = asyncio.ensure_future(controller.acquire())
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            controller.release(201, 0.1)
+            await waiter
+            self.assertEqual(controller.in_flight, 2)
+        asyncio.run(run())
+
+class TestJournal(unittest.TestCase):
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = Journal(os.path.join(directory, 'journal.db'), run = 'test')
+            journal.mark_posted({'jakob1': {'data': {}}})
+            journal.mark_failed(['jakob2'])
+            journal.mark_batch(0, 'User Injection', 1)
+            self.assertEqual(journal.finished(['jakob1', 'jakob2', 'jakob3']), {'jakob2'})
+            self.assertEqual(journal.posted(['jakob1', 'jakob2']), {'jakob1': {'data': {}}})
+            journal.mark_done(['jakob1'])
+            self.assertEqual(journal.finished(['jakob1', 'jakob2']), {'jakob1', 'jakob2'})
+            self.assertEqual(journal.next_batch(), 1)
+            journal.close()
+
+class TestResponseCache(unittest.TestCase):
+    def test_expiry(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResponseCache(os.path.join(directory, 'cache.db'), ttl = 0)
+            cache.put({'jakob1': {'data': {}}})
+            self.assertEqual(cache.get(['jakob1']), {})
+            self.assertEqual(cache.get(['jakob1'], max_age = None), {'jakob1': {'data': {}}})
+            cache.close()
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResponseCache(os.path.join(directory, 'cache.db'), max_entries = 2)
+            cache.put({'jakob1': {}})
+            cache.put({'jakob2': {}})
+            cache.get(['jakob1'])
+            cache.put({'jakob3': {}})
+            self.assertEqual(set(cache.get(['jakob1', 'jakob2', 'jakob3']).keys()), {'jakob1', 'jakob3'})
+            cache.close()
+
+class TestChangeIndex(unittest.TestCase):
+    def test_unchanged(self):
+        with tempfile.TemporaryDirectory() as directory:
+            changes = ChangeIndex(os.path.join(directory, 'changes.db'))
+            users = [User(github = "jakob1", name = "Jakob"), User(github = "jakob2")]
+            self.assertEqual(changes.unchanged(users), set())
+            changes.mark(users)
+            self.assertEqual(changes.unchanged(users + [User(github = "jakob3")]), {'jakob1', 'jakob2'})
+            self.assertEqual(changes.unchanged([User(github = "jakob1", name = "Jakob H.")]), set())
+            changes.close()
+
+    def test_skips_unchanged_users(self):
+        with tempfile.TemporaryDirectory() as directory, FakeOrbit(latency = 0) as server:
+            orbit = Orbit("key", "gitpod", base_url = server.url, limiter = RateLimiter(limit = 1000, period = 1))
+            cache = ResponseCache(os.path.join(directory, 'cache.db'))
+            changes = ChangeIndex(os.path.join(directory, 'changes.db'))
+            manager = AsyncManager(orbit, cache = cache, changes = changes, write_options = {'client': FakeBigQuery()})
+            manager.execute([User(github = f"jakob{index}") for index in range(10)])
+            manager.execute([User(github = f"jakob{index}", name = "Jakob" if index < 3 else None) for index in range(10)])
+            self.assertEqual(server.requests, 13)
+            cache.close()
+            changes.close()
+            orbit.close()
+
+    def test_refreshes_unchanged_users(self):
+        with tempfile.TemporaryDirectory() as directory, FakeOrbit(latency = 0, members = 5) as server:
+            orbit = Orbit("key", "gitpod", base_url = server.url, limiter = RateLimiter(limit = 1000, period = 1))
+            cache = ResponseCache(os.path.join(directory, 'cache.db'))
+            changes = ChangeIndex(os.path.join(directory, 'changes.db'))
+            users = [User(github = f"user{index}") for index in range(5)]
+            AsyncManager(orbit, cache = cache, changes = changes, write_options = {'client': FakeBigQuery()}).execute(users)
+            #unchanged users are posted again once their response is older than refresh_age
+            AsyncManager(orbit, cache = cache, changes = changes, refresh_age = 0, write_options = {'client': FakeBigQuery()}).execute(users)
+            self.assertEqual(server.requests, 10)
+            #an export refreshes the cached responses of the exported members
+            manager = AsyncManager(orbit, cache = cache, changes = changes, refresh_age = 60, write_options = {'client': FakeBigQuery()})
+            manager.export(items = 10, prefetch = 1)
+            self.assertEqual(cache.get(['user0'])['user0']['data']['id'], 'user0')
+            manager.execute(users)
+            self.assertEqual(server.requests, 11)
+            cache.close()
+            changes.close()
+            orbit.close()
+
+class TestMember(unittest.TestCase):
+    def test_get_and_delete(self):
+        with FakeOrbit(latency = 0) as server:
+            orbit = Orbit("key", "gitpod", base_url = server.url, limiter = RateLimiter(limit = 1000, period = 1), retry = RetryPolicy(retries = 2, base = 0.001))
+            member, deleted = asyncio.run(self._get_and_delete(orbit))
+            self.assertEqual(member['data']['id'], 'jakob1')
+            self.assertEqual(deleted, {})
+            #both requests take a slot of the concurrency controller and are retried
+            self.assertEqual(orbit.concurrency.in_flight, 0)
+            server.error_rate = 1
+            server.requests = 0
+            self.assertEqual(asyncio.run(self._get_and_delete(orbit))[0], {})
+            self.assertEqual(server.requests, 4)
+            orbit.close()
+
+    @staticmethod
+    async def _get_and_delete(orbit):
+        session = await orbit.open_session()
+        try:
+            return await orbit.async_get_member(session, 'jakob1'), await orbit.async_delete_member(session, 'jakob1')
+        finally:
+            await orbit.close_session()
+
+class TestExport(unittest.TestCase):
+    def test_export(self):
+        with FakeOrbit(latency = 0, members = 250) as server:
+            client = FakeBigQuery()
+            orbit = Orbit("key", "gitpod", base_url = server.url, limiter = RateLimiter(limit = 1000, period = 1))
+            count = AsyncManager(orbit, write_options = {'client': client}).export(items = 100, prefetch = 2)
+            self.assertEqual((count, server.requests), (250, 3))
+            self.assertEqual(client.rows['gitpod-growth.orbit.users'], 250)
+            orbit.close()
+
+    def test_failed_pages(self):
+        with FakeOrbit(latency = 0, members = 1000, error_rate = 1) as server:
+            orbit = Orbit("key", "gitpod", base_url = server.url, limiter = RateLimiter(limit = 1000, period = 1), retry = RetryPolicy(retries = 1, base = 0.001))
+            manager = AsyncManager(orbit, write_options = {'client': FakeBigQuery()})
+            #the export stops instead of requesting pages forever while the number of pages is unknown
+            with self.assertRaises(RuntimeError):
+                manager.export(items = 10, prefetch = 2)
+            self.assertLessEqual(server.requests, 4)
+            #once the number of pages is known, failed pages are skipped up to max_failed_pages in a row
+            server.error_rate, server.requests, pages = 0, 0, []
+            with self.assertRaises(RuntimeError):
+                asyncio.run(self._export(orbit, server, pages))
+            self.assertEqual((len(pages), server.requests), (1, 5))
+            orbit.close()
+
+    @staticmethod
+    async def _export(orbit, server, pages):
+        session = await orbit.open_session()
+        try:
+            async for members in orbit.export_members(session, items = 10, prefetch = 1, max_failed_pages = 2):
+                pages.append(members)
+                server.error_rate = 1
+        finally:
+            await orbit.close_session()
+
+class TestJSONCodec(unittest.TestCase):
+    def test_decode_member(self):
+        body = b'{"data": {"id": "1", "attributes": {"github": "jakob1", "reach": 4, "tags": ["a"], "languages": ["Go"]}}}'
+        backends = ['json'] + (['orjson'] if orjson != None else []) + (['msgspec'] if msgspec != None else [])
+        for backend in backends:
+            codec = JSONCodec(backend = backend, keys = ['github', 'reach', 'love', 'languages'])
+            self.assertEqual(codec.decode_member(body), {'data': {'attributes': {'github': 'jakob1', 'reach': 4, 'love': None, 'languages': ['Go']}}})
+            self.assertEqual(codec.decode(codec.encode({'member': {'github': 'jakob1'}})), {'member': {'github': 'jakob1'}})
+            self.assertEqual(codec.decode_member(b'{"errors": "not found"}'), {})
+
+class TestAccessor(unittest.TestCase):
+    def test_filter_time(self):
+        accessor = Accessor(query = "SELECT 1")
+        accessor.filter_time(lower_limit = dt.date(2021, 6, 28), upper_limit = dt.date(2021, 6, 30))
+        self.assertEqual(accessor.parameters[0].type_, 'TIMESTAMP')
+        self.assertEqual(accessor.parameters[0].value, dt.datetime(2021, 6, 28, tzinfo = dt.timezone.utc))
+        #date and datetime columns are compared with parameters of their own type
+        accessor = Accessor(query = "SELECT 1")
+        accessor.filter_time(column = 'signup_day', type = 'DATE', lower_limit = dt.datetime(2021, 6, 28, 12), upper_limit = dt.date(2021, 6, 30))
+        self.assertEqual([(parameter.type_, parameter.value) for parameter in accessor.parameters], [('DATE', dt.date(2021, 6, 28)), ('DATE', dt.date(2021, 6, 30))])
+        accessor = Accessor(query = "SELECT 1")
+        accessor.filter_time(type = 'DATETIME', lower_limit = dt.date(2021, 6, 28), upper_limit = dt.datetime(2021, 6, 30, 2, tzinfo = dt.timezone(dt.timedelta(hours = 2))))
+        self.assertEqual([parameter.value for parameter in accessor.parameters], [dt.datetime(2021, 6, 28), dt.datetime(2021, 6, 30)])
+
+    def test_filter_incremental(self):
+        mark = (dt.datetime(2021, 6, 28, 12, tzinfo = dt.timezone.utc), 'jakob1')
+        accessor = Accessor(query = "SELECT 1")
+        accessor.filter_incremental(mark)
+        #users with the timestamp of the mark are ordered by their id
+        self.assertIn("WHERE created_at >= @mark_created_at AND (created_at > @mark_created_at OR COALESCE(github, email) > @mark_id)", accessor.query)
+        self.assertEqual([(parameter.name, parameter.type_, parameter.value) for parameter in accessor.parameters], [
+            ('mark_created_at', 'TIMESTAMP', mark[0]),
+            ('mark_id', 'STRING', 'jakob1')
+        ])
+        accessor = Accessor(query = "SELECT 1")
+        accessor.filter_incremental(mark, column = 'signup_time', type = 'DATETIME')
+        self.assertIn("WHERE signup_time >= @mark_created_at", accessor.query)
+        self.assertEqual((accessor.parameters[0].type_, accessor.parameters[0].value), ('DATETIME', dt.datetime(2021, 6, 28, 12)))
+        #without a mark, the time window is applied to the same column
+        accessor = Accessor(query = "SELECT 1")
+        accessor.filter_incremental(None, column = 'signup_time', type = 'DATETIME')
+        self.assertEqual([parameter.type_ for parameter in accessor.parameters], ['DATETIME', 'DATETIME'])
+
+    def test_high_water_mark(self):
+        accessor = Accessor(query = "SELECT * FROM signups", client = FakeBigQuery(users = 25))
+        marks = [accessor.high_water_mark for user in accessor.stream(page_size = 10)]
+        #the mark advances with every page to its latest user
+        self.assertEqual([mark[1] for mark in marks[::10]], ['user9', 'user19', 'user24'])
+        self.assertEqual(accessor.high_water_mark, (dt.datetime(2021, 6, 28, 0, 0, 24, tzinfo = dt.timezone.utc), 'user24'))
+
+class TestIntegrator(unittest.TestCase):
+    def test_chunks(self):
+        payload = [{'github': 'jakob' + str(i)} for i in range(25)]
+        integrator = Integrator('dataset.table', payload, max_rows = 10)
+        self.assertEqual([(offset, len(chunk)) for offset, chunk in integrator.chunks()], [(0, 10), (10, 10), (20, 5)])
+        integrator = Integrator('dataset.table', payload, max_bytes = 50)
+        self.assertTrue(all(len(chunk) == 2 for _, chunk in list(integrator.chunks())[:-1]))
+
+    def test_upsert(self):
+        client = FakeBigQuery()
+        payload = [{'github': 'jakob1', 'language': 'Python', 'rank': 1}]
+        integrator = Integrator('project.dataset.languages', payload, client = client, mode = 'upsert', keys = ['github', 'language'])
+        integrator.execute()
+        self.assertEqual(integrator.errors, [])
+        self.assertEqual(len(client.queries), 1)
+        self.assertIn("ON T.`github` = S.`github` AND T.`language` = S.`language` WHEN MATCHED THEN UPDATE SET `rank` = S.`rank`", client.queries[0])
+        #the staging table is dropped after the merge
+        self.assertEqual(client.rows, {})
+
+    def test_upsert_run(self):
+        with tempfile.TemporaryDirectory() as directory, FakeOrbit(latency = 0, members = 250) as server:
+            client = FakeBigQuery()
+            orbit = Orbit("key", "gitpod", base_url = server.url, limiter = RateLimiter(limit = 1000, period = 1))
+            journal = Journal(os.path.join(directory, 'journal.db'))
+            manager = AsyncManager(orbit, journal = journal, write_options = {'client': client, 'mode': 'upsert'})
+            users = [User(github = f"user{index}") for index in range(300)]
+            self.assertEqual(manager.execute(users, batch_size = 50), 300)
+            #the sub batches of a run are staged and merged with one MERGE per table
+            merges = [query.split('`')[1] for query in client.queries if query.startswith("MERGE")]
+            self.assertEqual(sorted(merges), ['gitpod-growth.orbit.languages', 'gitpod-growth.orbit.users'])
+            self.assertEqual(client.rows, {})
+            self.assertEqual(len(journal.finished([user.get_id() for user in users])), 300)
+            manager.export(items = 100)
+            self.assertEqual(len([query for query in client.queries if query.startswith("MERGE")]), 4)
+            journal.close()
+            orbit.close()
+
+    def test_load_run(self):
+        with FakeOrbit(latency = 0) as server:
+            client = FakeBigQuery()
+            orbit = Orbit("key", "gitpod", base_url = server.url, limiter = RateLimiter(limit = 1000, period = 1))
+            manager = AsyncManager(orbit, write_options = {'client': client, 'mode': 'load'})
+            manager.execute([User(github = f"user{index}") for index in range(300)], batch_size = 50)
+            #the staged sub batches reach the table in a single copy job instead of one load job per sub batch
+            self.assertEqual(sorted(client.rows), ['gitpod-growth.orbit.languages', 'gitpod-growth.orbit.users'])
+            self.assertEqual(client.rows['gitpod-growth.orbit.users'], 300)
+            self.assertEqual([table for table in client.loads if '_staging_' not in table], [])
+            orbit.close()
+
+    def test_insert_errors(self):
+        with FakeOrbit(latency = 0) as server:
+            client = FakeBigQuery()
+            client.insert_rows_json = lambda table, rows, row_ids = None: [{'index': 0, 'errors': ['invalid']}]
+            orbit = Orbit("key", "gitpod", base_url = server.url, limiter = RateLimiter(limit = 1000, period = 1))
+            manager = AsyncManager(orbit, write_options = {'client': client})
+            #the run completes, but reports the failed inserts, e.g. to keep the high-water mark of incremental runs
+            self.assertEqual(manager.execute([User(github = f"user{index}") for index in range(10)]), 10)
+            self.assertEqual(manager.errors, 2)
+            orbit.close()
+
+    def test_merge_query(self):
+        payload = [{'github': 'jakob1', 'name': 'Jakob', 'signup_date': None}]
+        query = Integrator('project.dataset.users', payload, mode = 'upsert').merge_query('project.dataset.staging')
+        #exported members have no signup date, which must not overwrite the one of the table
+        self.assertIn("UPDATE SET `name` = S.`name`, `signup_date` = COALESCE(S.`signup_date`, T.`signup_date`)", query)
+        self.assertIn("INSERT (`github`, `name`, `signup_date`) VALUES (S.`github`, S.`name`, S.`signup_date`)", query)
+
+class TestResponseTransformer(unittest.TestCase):
+    def test_transform(self):
+        attributes = {key: None for key in Orbit.DEFAULT_KEYS}
+        attributes.update({'github': 'jakob1', 'reach': 3, 'languages': ['python', 'go']})
+        response = {'bigquery': {'github': 'jakob1'}, 'orbit': {'data': {'attributes': attributes}}}
+        transformer = ResponseTransformer()
+        users, langs = transformer.transform([response, None])
+        user_response, lang_response = Orbit.parse_user_response(response)
+        user_response['signup_date'] = None
+        self.assertEqual(transformer.to_rows(users), [user_response])
+        self.assertEqual(transformer.to_rows(langs), lang_response)
+
+    def test_to_arrow(self):
+        transformer = ResponseTransformer()
+        #the types of a batch do not depend on its values, e.g. on exported members without signup date
+        empty = transformer.to_arrow({'github': ['jakob1'], 'github_followers': [None], 'orbit_love': [None], 'signup_date': [None]})
+        filled = transformer.to_arrow({'github': ['jakob2'], 'github_followers': [3], 'orbit_love': ['1.5'], 'signup_date': ['2021-06-28 12:00:00+00:00']})
+        self.assertEqual(empty.schema, filled.schema)
+        self.assertEqual(filled.column('orbit_love').to_pylist(), [1.5])
+
+class TestWatermark(unittest.TestCase):
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            watermark = Watermark(os.path.join(directory, 'watermark.json'))
+            self.assertIsNone(watermark.load())
+            created_at = dt.datetime(2021, 6, 28, 12, tzinfo = dt.timezone.utc)
+            watermark.save(created_at, 'jakob1')
+            self.assertEqual(watermark.load(), (created_at, 'jakob1'))
+
+class TestBackfill(unittest.TestCase):
+    def test_partitions(self):
+        backfill = Backfill(None, "SELECT 1", granularity = 'hour')
+        partitions = backfill.partitions(dt.datetime(2021, 6, 28, 22, 30), dt.date(2021, 6, 29))
+        self.assertEqual(partitions, [
+            (dt.datetime(2021, 6, 28, 22, 30), dt.datetime(2021, 6, 28, 23, 30)),
+            (dt.datetime(2021, 6, 28, 23, 30), dt.datetime(2021, 6, 29))
+        ])
+        self.assertEqual(len(Backfill(None, "SELECT 1").partitions(dt.date(2021, 6, 1), dt.date(2021, 7, 1))), 30)
+
+class TestShardedManager(unittest.TestCase):
+    def test_shard_of(self):
+        user = User(github = "jakob1")
+        self.assertEqual(shard_of(user, 4), shard_of(User(github = "jakob1", name = "jakob"), 4))
+        self.assertTrue(0 <= shard_of(user, 4) < 4)
+
+    def test_limit_of(self):
+        manager = ShardedManager(['key1', 'key2'], "gitpod", shards = 3, limit = 120)
+        self.assertEqual([manager.limit_of(shard) for shard in range(3)], [60, 120, 60])
+        self.assertEqual([manager.share_of(shard) for shard in range(3)], [0.5, 1, 0.5])
+
+    def test_execute(self):
+        users = [User(github = f"user{index}", email = f"user{index}@example.org") for index in range(50)]
+        with tempfile.TemporaryDirectory() as directory, FakeOrbit(latency = 0, limit = 1000, period = 1) as server:
+            path = os.path.join(directory, 'journal.db')
+            manager = ShardedManager(
+                "key", "gitpod", shards = 2, limit = 1000, period = 1, base_url = server.url, run = 'test', journal_path = path,
+                write_options = {'client': FakeBigQuery()}, batch_options = {'batch_size': 10}
+            )
+            self.assertEqual(manager.execute(users), 50)
+            self.assertEqual(server.requests, 50)
+            #every shard keeps the insert status of all of its batches
+            sizes = [len([user for user in users if shard_of(user, 2) == shard]) for shard in range(2)]
+            journal = Journal(path)
+            batches = journal.connection.execute("SELECT run, COUNT(*) FROM batches GROUP BY run ORDER BY run").fetchall()
+            journal.close()
+            self.assertEqual(batches, [(f"test_shard{shard}", 2 * -(-sizes[shard] // 10)) for shard in range(2)])
+        self.assertEqual(sorted(summary['shard'] for summary in manager.summary), [0, 1])
+
+class TestMetrics(unittest.TestCase):
+    def test_disabled(self):
+        metrics = Metrics()
+        metrics.inc('orbit_requests_total')
+        metrics.observe('orbit_request_seconds', 0.1)
+        self.assertEqual(metrics.to_prometheus(), "\n")
+
+    def test_prometheus(self):
+        metrics = Metrics(enabled = True)
+        metrics.inc('orbit_requests_total', status = 201)
+        metrics.observe('orbit_request_seconds', 0.02)
+        metrics.observe('orbit_request_seconds', 0.3)
+        text = metrics.to_prometheus()
+        self.assertIn('orbit_requests_total{status="201"} 1', text)
+        self.assertIn('orbit_request_seconds_bucket{le="0.025"} 1', text)
+        self.assertIn('orbit_request_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn('orbit_request_seconds_count 2', text)
+
+    def test_merge(self):
+        worker, coordinator = Metrics(enabled = True), Metrics(enabled = True)
+        worker.inc('users_processed_total', 120)
+        worker.observe('transform_seconds', 0.01)
+        coordinator.inc('users_processed_total', 80)
+        coordinator.merge(worker.snapshot())
+        summary = coordinator.summary()
+        self.assertEqual(summary['counters'], [{'name': 'users_processed_total', 'labels': {}, 'value': 200}])
+        self.assertEqual(summary['histograms'][0]['count'], 1)
+
+class TestBenchmark(unittest.TestCase):
+    def test_fake_orbit(self):
+        with FakeOrbit(latency = 0) as server:
+            for benchmark in [benchmark_async_manager, benchmark_batch_job]:
+                result = benchmark(server, 50, 20, 1000)
+                self.assertEqual((result['users'], result['failed']), (50, 0))
+
 class TestOrbit(unittest.TestCase):
     
     def test_get(self):
@@ -0,0 +1,133 @@
+import operator, datetime as dt
+from orbit import Orbit
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+class ResponseTransformer:
+    """
+    transforms a whole batch of Orbit responses into a users and a languages table in column oriented form, i.e. as
+    dictionaries of column name and list of values. The attributes to extract and their names are compiled once into an
+    item getter, so that no intermediate dictionaries are created per row. Keys and renames can be passed in the 'keys'
+    and 'rename' keywords and default to the ones of Orbit.parse_user_response. Arrow tables are built with the BigQuery
+    types of the columns in 'schema' (SCHEMA by default), so that their types do not depend on the values of a batch.
+    """
+    #BigQuery types of the columns of the users and languages tables
+    SCHEMA = {
+        "github": "STRING",
+        "name": "STRING",
+        "company": "STRING",
+        "location": "STRING",
+        "bio": "STRING",
+        "birthday": "STRING",
+        "orbit_love": "FLOAT",
+        "orbit_level": "INTEGER",
+        "orbit_activities": "INTEGER",
+        "orbit_reach": "INTEGER",
+        "github_followers": "INTEGER",
+        "twitter_followers": "INTEGER",
+        "twitter": "STRING",
+        "linkedin": "STRING",
+        "discourse": "STRING",
+        "email": "STRING",
+        "devto": "STRING",
+        "signup_date": "TIMESTAMP",
+        "language": "STRING",
+        "rank": "INTEGER",
+    }
+
+    def __init__(self, **kwargs):
+        keys = kwargs.get('keys', Orbit.DEFAULT_KEYS)
+        rename = kwargs.get('rename', Orbit.DEFAULT_RENAME)
+        self.keys = list(keys)
+        self.columns = [rename.get(key, key) for key in keys]
+        #an item getter with a single key returns a scalar instead of a tuple
+        getter = operator.itemgetter(*self.keys)
+        self.getter = getter if len(self.keys) > 1 else (lambda data: (getter(data),))
+        self.github = self.keys.index('github') if 'github' in self.keys else None
+        self.schema = kwargs.get('schema', self.SCHEMA)
+
+    def transform(self, batch):
+        """
+        returns the users and languages tables for a batch of responses as returned by Orbit.async_add_member. Rows
+        without Orbit data (e.g. failed requests) are skipped.
+        """
+        values, signup_dates = [], []
+        lang_github, lang_language, lang_rank = [], [], []
+        for row in batch:
+            if row is None or 'orbit' not in row or 'data' not in row['orbit']:
+                continue
+            data = row['orbit']['data']['attributes']
+            try:
+                extracted = self.getter(data)
+            except KeyError:
+                extracted = tuple(data.get(key, None) for key in self.keys)
+            values.append(extracted)
+            #TODO: This is a bridgegap solution. In the future, the date should come from a custom orbit event that records the Gitpod Signup.
+            signup_dates.append(row.get('bigquery', {}).get('created_at', None))
+
+            langs = data.get('languages', None)
+            if langs != None and self.github != None:
+                github = extracted[self.github]
+                lang_github.extend([github] * len(langs))
+                lang_language.extend(langs)
+                lang_rank.extend(range(1, len(langs) + 1))
+
+        users = {column: list(cells) for column, cells in zip(self.columns, zip(*values))} if len(values) > 0 else {column: [] for column in self.columns}
+        users['signup_date'] = signup_dates
+        langs = {"github": lang_github, "language": lang_language, "rank": lang_rank}
+        return users, langs
+
+    @staticmethod
+    def num_rows(table):
+        return len(next(iter(table.values()), []))
+
+    @staticmethod
+    def to_rows(table):
+        """
+        converts a column oriented table into a list of row dictionaries, e.g. for streaming inserts.
+        """
+        columns = list(table.keys())
+        return [dict(zip(columns, cells)) for cells in zip(*table.values())]
+
+    @staticmethod
+    def arrow_type(bigquery_type):
+        """
+        returns the Arrow type of a BigQuery type, or None if it is not supported.
+        """
+        types = {
+            "STRING": pa.string(),
+            "INTEGER": pa.int64(),
+            "INT64": pa.int64(),
+            "FLOAT": pa.float64(),
+            "FLOAT64": pa.float64(),
+            "BOOLEAN": pa.bool_(),
+            "BOOL": pa.bool_(),
+            "TIMESTAMP": pa.timestamp('us', tz = 'UTC'),
+        }
+        return types.get(bigquery_type, None)
+
+    def to_arrow(self, table):
+        """
+        converts a column oriented table into an Arrow table. Requires pyarrow. Columns are typed according to the schema,
+        values that Arrow does not convert implicitly (e.g. numbers sent as strings) are cast. Columns missing from the
+        schema are typed by their values and as strings if they only contain None.
+        """
+        if pa == None:
+            raise ImportError("pyarrow is required to convert tables into Arrow.")
+        arrays = {}
+        for column, cells in table.items():
+            kind = self.arrow_type(self.schema.get(column, None))
+            if kind != None and pa.types.is_timestamp(kind):
+                cells = [dt.datetime.fromisoformat(cell) if isinstance(cell, str) else cell for cell in cells]
+            if kind == None:
+                array = pa.array(cells)
+                arrays[column] = array.cast(pa.string()) if pa.types.is_null(array.type) else array
+                continue
+            try:
+                arrays[column] = pa.array(cells, type = kind)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                arrays[column] = pa.array(cells).cast(kind)
+        return pa.table(arrays)
@@ -1,6 +1,18 @@
 import re, warnings, datetime as dt
 
+try:
+    import pyarrow.compute as pc
+except ImportError:
+    pc = None
+
+#compiled once, as the email of every retrieved user is validated
+EMAIL_PATTERN = "^[a-zA-Z0-9.!#$%&'*+/=?^_`{|}~-]+@[a-zA-Z0-9-]+(?:\\.[a-zA-Z0-9-]+)*$"
+EMAIL_REGEX = re.compile(EMAIL_PATTERN)
+
 class User:
+    #slots instead of an instance dictionary keep the memory footprint of millions of users small
+    __slots__ = ('__email', '__name', '__github', '__created_at')
+
     def __init__(self, **kwargs):
         self.email = kwargs.get('email', None)
         self.name = kwargs.get('name', None)
@@ -23,7 +35,7 @@ class User:
         if email == None:
             self.__email = None
         #check for email validity with regex
-        elif(re.search("^[a-zA-Z0-9.!#$%&'*+/=?^_`{|}~-]+@[a-zA-Z0-9-]+(?:\.[a-zA-Z0-9-]+)*$", email)):
+        elif(isinstance(email, str) and EMAIL_REGEX.search(email)):
             self.__email = email
         else:
             self.__email = None
@@ -65,6 +77,70 @@ class User:
             self.__created_at = None
             warnings.warn(f"'created_at' requires a DateTime datatype, not {type(created_at)}. The attribute was set to None")
     
+    @classmethod
+    def from_columns(cls, emails, names, githubs, created_ats, **kwargs):
+        """
+        creates users from equally long sequences of attribute values without going through the property setters. Invalid
+        values are set to None like in the setters, but instead of one warning per value, a single warning summarizing the
+        number of invalid values per attribute is emitted. Pass a sequence of booleans in the 'valid_emails' keyword if the
+        emails have already been validated.
+        """
+        valid_emails = kwargs.get('valid_emails', None)
+        if valid_emails == None:
+            match = EMAIL_REGEX.search
+            valid_emails = [email is None or (isinstance(email, str) and match(email) is not None) for email in emails]
+        invalid = {'email': 0, 'name': 0, 'github': 0, 'created_at': 0}
+        users, new = [], object.__new__
+        for email, valid_email, name, github, created_at in zip(emails, valid_emails, names, githubs, created_ats):
+            user = new(cls)
+            if not valid_email and email is not None:
+                email = None
+                invalid['email'] += 1
+            if name is not None and not isinstance(name, str):
+                name = None
+                invalid['name'] += 1
+            if github is not None and not isinstance(github, str):
+                github = None
+                invalid['github'] += 1
+            if created_at is not None and not isinstance(created_at, dt.datetime):
+                created_at = None
+                invalid['created_at'] += 1
+            user.__email, user.__name, user.__github, user.__created_at = email, name, github, created_at
+            users.append(user)
+        if sum(invalid.values()) > 0:
+            summary = ", ".join(f"{count} invalid '{key}'" for key, count in invalid.items() if count > 0)
+            warnings.warn(f"{summary} in {len(users)} users. The invalid values were set to None.")
+        return users
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        creates users from rows (e.g. a page of BigQuery rows) with the keys 'email', 'name', 'github' and 'created_at'.
+        """
+        rows = list(rows)
+        return cls.from_columns(
+            [row['email'] for row in rows],
+            [row['name'] for row in rows],
+            [row['github'] for row in rows],
+            [row['created_at'] for row in rows]
+        )
+
+    @classmethod
+    def from_arrow(cls, batch):
+        """
+        creates users from an Arrow record batch or table with the columns 'email', 'name', 'github' and 'created_at'. The
+        emails of the whole batch are validated at once.
+        """
+        emails = batch.column('email')
+        valid_emails = pc.fill_null(pc.match_substring_regex(emails, EMAIL_PATTERN), False).to_pylist()
+        return cls.from_columns(
+            emails.to_pylist(),
+            batch.column('name').to_pylist(),
+            batch.column('github').to_pylist(),
+            batch.column('created_at').to_pylist(),
+            valid_emails = valid_emails
+        )
+
     def to_dict(self):
         out = {}
         if self.email != None:
@@ -0,0 +1,28 @@
+import os, json, datetime as dt
+
+class Watermark:
+    """
+    persists the high-water mark of incremental enrichment runs in a JSON file. The mark consists of the latest
+    'created_at' that was processed and the id (User.get_id) of the latest user with that timestamp, which breaks ties
+    between users that signed up at the same time.
+    """
+    def __init__(self, path = 'watermark.json'):
+        self.path = path
+
+    def load(self):
+        """
+        returns the persisted mark as tuple of created_at and id, or None if no run has completed yet.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as infile:
+            mark = json.load(infile)
+        return dt.datetime.fromisoformat(mark['created_at']), mark['id']
+
+    def save(self, created_at, id):
+        """
+        persists the mark. The file is replaced atomically, so that an aborted write does not lose the previous mark.
+        """
+        with open(self.path + '.tmp', 'w') as outfile:
+            json.dump({'created_at': created_at.isoformat(), 'id': id}, outfile)
+        os.replace(self.path + '.tmp', self.path)